@@ -0,0 +1,40 @@
+'''
+Verify the stored products against the checksums in their manifests
+(manifest.safe for SAFE products, xfdumanifest.xml for SEN3 products).
+
+Results are cached in an SQLite database keyed by path, size, mtime and
+inode, so after the first full audit only new or changed files are rehashed.
+Exits with status 1 if any file is missing or fails its checksum.
+'''
+
+import argparse
+import sys
+
+from lib.utils import init_logging, load_and_combine_configs
+from lib.archive_audit import audit_archive
+
+def run_audit(mission_config_path, root=None, workers=None):
+    logger = init_logging()
+    config = load_and_combine_configs(mission_config_path, 'config/config.yaml')
+    root = root or config['output_dir']
+    cache_db_path = config.get('audit_cache_db', 'audit_cache.db')
+    workers = workers or config.get('audit_workers')
+
+    logger.info(f"------Auditing products in {root}------")
+    failures = audit_archive(root, cache_db_path, workers)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description="Verify stored products against their manifest checksums.")
+
+    parser.add_argument('--mission_config_path', '-c', default='config/config_production.yaml',
+                        help="Path to the YAML configuration file for that mission")
+    parser.add_argument('--root', '-r', default=None,
+                        help="Directory to audit, defaults to output_dir from the config")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="Number of files hashed in parallel")
+    args = parser.parse_args()
+
+    sys.exit(run_audit(args.mission_config_path, args.root, args.workers))
@@ -0,0 +1,26 @@
+'''
+(Re)build the inventory of stored products used by sync_query.py to skip
+products that are already on disk (inventory_db in the config).
+
+The inventory is updated as products are stored, a periodic rebuild picks
+up products added or removed by other means.
+'''
+
+import argparse
+
+from lib.utils import load_and_combine_configs
+from lib.inventory import build_inventory
+
+if __name__ == "__main__":
+
+    # Argument parser setup
+    parser = argparse.ArgumentParser(description="Crawl the product storage into the inventory database.")
+
+    parser.add_argument('--mission_config_path', '-c', default='config/config_production.yaml',
+                        help="Path to the YAML configuration file for that mission")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="Number of directories scanned in parallel")
+    args = parser.parse_args()
+
+    config = load_and_combine_configs(args.mission_config_path, 'config/config.yaml')
+    build_inventory(config['inventory_db'], config['output_dir'], args.workers or config.get('inventory_workers'))
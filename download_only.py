@@ -27,7 +27,7 @@ def main():
     if not os.path.exists(source):
         logger.info(f"------------File {source} does not exist-------------")
         sys.exit(1)
-    if not source.endswith('.json'):
+    if not source.endswith(('.json', '.ndjson')):
         logger.info(f"------------File {source} is not a JSON file-------------")
         sys.exit(1)
 
@@ -36,15 +36,15 @@ def main():
     products = metadata_products.get_product_ids_and_titles()
 
     try:
-        access_token = get_access_token()
-        # Do something with the access token here
+        # Fail early on bad credentials, the downloads reuse the cached token
+        get_access_token()
     except Exception as e:
         # Print the error message and exit
         logger.error(e)
         exit(1)  # Exit with a non-zero status code to indicate an error
 
     for product_id,product_title in products.items():
-        download_product(product_id, product_title, access_token)
+        download_product(product_id, product_title)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,187 @@
+'''
+Audit of stored products against the checksums in their own manifests.
+
+Every SAFE (Sentinel-1/2) product lists the MD5 of its files in manifest.safe
+and every SEN3 (Sentinel-3) product in xfdumanifest.xml. The audit walks the
+platform/year/month/day/product_type tree, verifies each listed file and
+keeps the results in an SQLite cache keyed by path, size, mtime and inode,
+so repeat audits only rehash files that changed since they were verified.
+'''
+
+import concurrent.futures
+import os
+import sqlite3
+import time
+import xml.etree.ElementTree as ET
+from lib.utils import init_logging
+from lib.integrity_check import get_file_checksum
+
+logger = init_logging()
+
+PRODUCT_EXTENSIONS = ('.SAFE', '.SEN3')
+MANIFEST_FILENAMES = ('manifest.safe', 'xfdumanifest.xml')
+# Checksum names used in the manifests, mapped to integrity_check modes
+CHECKSUM_MODES = {'MD5': 'md5'}
+
+def find_products(root):
+    '''
+    Yields the paths of all SAFE/SEN3 products below root.
+    Hidden directories (such as extraction staging directories) are skipped.
+    '''
+    try:
+        entries = list(os.scandir(root))
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        return
+    for entry in entries:
+        if entry.name.startswith('.') or not entry.is_dir(follow_symlinks=False):
+            continue
+        if entry.name.endswith(PRODUCT_EXTENSIONS):
+            yield entry.path
+        else:
+            yield from find_products(entry.path)
+
+def read_manifest(product_path):
+    '''
+    Returns a list of (relative path, checksum name, checksum, size) for the
+    files listed in the product's manifest, or None if it has no manifest.
+    size is None when the manifest does not give one.
+    '''
+    for manifest_filename in MANIFEST_FILENAMES:
+        manifest_path = os.path.join(product_path, manifest_filename)
+        if os.path.exists(manifest_path):
+            break
+    else:
+        return None
+
+    files = []
+    for _, element in ET.iterparse(manifest_path):
+        if not element.tag.endswith('byteStream'):
+            continue
+        location = checksum = None
+        for child in element:
+            if child.tag.endswith('fileLocation'):
+                location = child.get('href')
+            elif child.tag.endswith('checksum'):
+                checksum = child
+        if location and checksum is not None and checksum.text:
+            size = element.get('size')
+            files.append((
+                os.path.normpath(location),
+                checksum.get('checksumName', 'MD5').upper(),
+                checksum.text.strip().lower(),
+                int(size) if size else None
+            ))
+        element.clear()
+    return files
+
+class AuditCache:
+    '''
+    SQLite cache of verified files, keyed by path. A cached result is only
+    reused while the file's size, mtime and inode are unchanged and the
+    manifest still expects the same checksum.
+    '''
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                expected_checksum TEXT,
+                passed INTEGER,
+                verified_at REAL
+            )
+        """)
+
+    def lookup(self, path, stat, expected_checksum):
+        row = self.conn.execute(
+            "SELECT passed FROM files WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ? AND expected_checksum = ?",
+            (path, stat.st_size, stat.st_mtime_ns, stat.st_ino, expected_checksum)
+        ).fetchone()
+        return None if row is None else bool(row[0])
+
+    def store(self, results):
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, inode, expected_checksum, passed, verified_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                results
+            )
+
+    def close(self):
+        self.conn.close()
+
+def verify_file(path, checksum_name, expected_checksum):
+    '''
+    Hash a file and compare it with the checksum from the manifest.
+    '''
+    return get_file_checksum(path, CHECKSUM_MODES[checksum_name]) == expected_checksum
+
+def audit_product(product_path, cache, executor):
+    '''
+    Verify one product against its manifest.
+    Returns (number of files rehashed, list of failures).
+    '''
+    manifest = read_manifest(product_path)
+    if manifest is None:
+        return 0, [(product_path, 'no manifest')]
+
+    failures = []
+    to_hash = {}
+    for relative_path, checksum_name, expected_checksum, expected_size in manifest:
+        path = os.path.join(product_path, relative_path)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            failures.append((path, 'missing'))
+            continue
+        if expected_size is not None and stat.st_size != expected_size:
+            failures.append((path, 'size mismatch'))
+            continue
+        if checksum_name not in CHECKSUM_MODES:
+            continue
+
+        passed = cache.lookup(path, stat, expected_checksum)
+        if passed is None:
+            future = executor.submit(verify_file, path, checksum_name, expected_checksum)
+            to_hash[future] = (path, stat, expected_checksum)
+        elif not passed:
+            failures.append((path, 'checksum mismatch'))
+
+    results = []
+    for future in concurrent.futures.as_completed(to_hash):
+        path, stat, expected_checksum = to_hash[future]
+        passed = future.result()
+        if not passed:
+            failures.append((path, 'checksum mismatch'))
+        results.append((path, stat.st_size, stat.st_mtime_ns, stat.st_ino, expected_checksum, int(passed), time.time()))
+    cache.store(results)
+
+    return len(results), failures
+
+def audit_archive(root, cache_db_path, workers=None):
+    '''
+    Audit every product below root. Returns a list of (path, reason) failures.
+    '''
+    start = time.monotonic()
+    cache = AuditCache(cache_db_path)
+    failures = []
+    products = 0
+    rehashed = 0
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for product_path in find_products(root):
+                product_rehashed, product_failures = audit_product(product_path, cache, executor)
+                products += 1
+                rehashed += product_rehashed
+                for path, reason in product_failures:
+                    logger.error(f"------{reason}: {path}------")
+                failures.extend(product_failures)
+    finally:
+        cache.close()
+
+    logger.info(f"------Audited {products} products in {time.monotonic() - start:.1f}s: {rehashed} files rehashed, {len(failures)} failures------")
+    return failures
@@ -0,0 +1,202 @@
+'''
+asyncio download engine, an alternative to the ThreadPoolExecutor engine in
+lib/parallel_download.py for queues of many small products.
+
+Selected with "download_engine: asyncio" in the config and used through the
+same download_list_of_products(list_of_products, config) contract. Needs the
+aiohttp package, which the default thread engine does not.
+
+Partial downloads use the same .part/.part.json files as the thread engine,
+so either engine can resume what the other left behind.
+'''
+
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timezone
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+from lib.utils import init_logging, get_cutoff_time
+from lib.token_manager import get_token_manager
+from lib.stream_download import (
+    CHUNK_SIZE, PART_SUFFIX, REDIRECT_CODES, load_sidecar, save_sidecar,
+    discard_partial_download, check_download_response, check_download_length,
+    get_validator, get_hasher, hash_file, verify_checksum
+)
+
+logger = init_logging()
+
+async def open_product_stream(session, url, token_manager, headers=None):
+    '''
+    Follow the redirect chain by hand with the access token on every hop and
+    return the final response, repeating once with a renewed token on HTTP 401.
+    '''
+    for attempt in range(2):
+        token = await asyncio.to_thread(token_manager.get_token)
+        request_headers = {**(headers or {}), 'Authorization': f'Bearer {token}'}
+        response = await session.get(url, headers=request_headers, allow_redirects=False)
+
+        while response.status in REDIRECT_CODES:
+            location = response.headers['Location']
+            response.release()
+            response = await session.get(location, headers=request_headers, allow_redirects=False)
+
+        if response.status == 401 and attempt == 0:
+            response.release()
+            await asyncio.to_thread(token_manager.refresh, token)
+            continue
+        return response
+
+async def download_product(session, product_id, product_title, tmp_storage_area, token_manager, chunk_size=CHUNK_SIZE, checksum=None):
+    '''
+    Download product from Copernicus Data Space Ecosystem, resuming an
+    unfinished .part file. File writes (and hashing against checksum, if
+    given) run in a worker thread so the event loop keeps serving the other
+    downloads.
+    '''
+    logger.info(f"------Downloading product: {product_title}-------")
+    url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
+    extension = 'nc' if product_title.startswith('S5') else 'zip'
+    output_filepath = os.path.join(tmp_storage_area, f"{product_title}.{extension}")
+    part_filepath = output_filepath + PART_SUFFIX
+
+    state = load_sidecar(output_filepath)
+    hasher = get_hasher(checksum, output_filepath)
+    headers = {}
+    offset = 0
+    if state and state.get('url') == url and not state.get('segmented') and os.path.exists(part_filepath):
+        offset = os.path.getsize(part_filepath)
+    else:
+        discard_partial_download(output_filepath)
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        if state.get('validator'):
+            headers['If-Range'] = state['validator']
+
+    start = time.monotonic()
+    response = await open_product_stream(session, url, token_manager, headers)
+    try:
+        if response.status != 416:
+            response.raise_for_status()
+        # The same checks as the thread engine (see download_resumable)
+        mode, expected_length = check_download_response(response.status, response.headers, offset, state, output_filepath)
+
+        if mode is None:
+            if hasher:
+                await asyncio.to_thread(hash_file, hasher, part_filepath, chunk_size)
+        else:
+            if mode == 'ab':
+                if hasher:
+                    await asyncio.to_thread(hash_file, hasher, part_filepath, chunk_size)
+            else:
+                offset = 0
+
+            save_sidecar(output_filepath, {
+                'url': url,
+                'expected_length': expected_length,
+                'validator': get_validator(response.headers),
+            })
+
+            f = await asyncio.to_thread(open, part_filepath, mode)
+
+            def write_chunk(chunk):
+                f.write(chunk)
+                if hasher:
+                    hasher.update(chunk)
+
+            try:
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    await asyncio.to_thread(write_chunk, chunk)
+            finally:
+                await asyncio.to_thread(f.close)
+    finally:
+        response.release()
+
+    written = check_download_length(output_filepath, expected_length)
+
+    if hasher:
+        verify_checksum(hasher, checksum, output_filepath)
+
+    os.replace(part_filepath, output_filepath)
+    discard_partial_download(output_filepath)
+    elapsed = time.monotonic() - start
+    logger.debug(f"------{product_title}: {written - offset} bytes in {elapsed:.1f}s------")
+    return written
+
+async def download_product_with_retries(session, product_id, title, tmp_storage_area, token_manager, max_retries, slots, chunk_size=CHUNK_SIZE, checksum=None):
+    async with slots:
+        retries = 0
+        while retries < max_retries:
+            try:
+                return await download_product(session, product_id, title, tmp_storage_area, token_manager, chunk_size, checksum)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                retries += 1
+                print(f"Retry {retries}/{max_retries} for product {product_id} ({title}) due to error: {e}")
+                if retries < max_retries:
+                    await asyncio.sleep(1)
+        raise Exception(f"Failed to download product {product_id} ({title}) after {max_retries} retries.")
+
+async def download_products(list_of_products, config, token_manager, checksums=None):
+    '''
+    Download all products concurrently, at most max_parallel_downloads at a
+    time and max_connections_per_host connections per host. Downloads still
+    running at the cutoff time are cancelled, leaving resumable .part files.
+    '''
+    max_parallel_downloads = config['max_parallel_downloads']
+    connector = aiohttp.TCPConnector(
+        limit=config.get('max_connections', max_parallel_downloads),
+        limit_per_host=config.get('max_connections_per_host', max_parallel_downloads)
+    )
+    slots = asyncio.Semaphore(max_parallel_downloads)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=300)
+    chunk_size = config.get('download_chunk_size', CHUNK_SIZE)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        tasks = {
+            asyncio.create_task(download_product_with_retries(
+                session, pid, title, config['tmp_storage_area'], token_manager,
+                config['max_retries_per_iteration'], slots, chunk_size,
+                checksums.get(pid) if checksums else None
+            )): (pid, title)
+            for pid, title in list_of_products
+        }
+
+        cutoff = get_cutoff_time(config.get('download_cutoff', '23:30'))
+        time_left = max((cutoff - datetime.now(timezone.utc)).total_seconds(), 0)
+        done, pending = await asyncio.wait(tasks, timeout=time_left)
+
+        if pending:
+            logger.info(f"------Reached cutoff {cutoff.time()}, cancelling {len(pending)} downloads------")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        for task in done:
+            product_id, title = tasks[task]
+            if task.exception():
+                print(f"Product {product_id} ({title}) generated an exception: {task.exception()}")
+            else:
+                print(f"Downloaded product {product_id} ({title}): {task.result()}")
+
+def download_list_of_products(list_of_products, config, checksums=None):
+    # Imported here to avoid a circular import with the thread engine
+    from lib.parallel_download import check_download_status
+
+    if aiohttp is None:
+        sys.exit("The asyncio download engine needs the aiohttp package (pip install aiohttp)")
+
+    token_manager = get_token_manager(config['username'], config['password'])
+    try:
+        token_manager.get_token()
+    except Exception as e:
+        sys.exit(e)
+
+    asyncio.run(download_products(list_of_products, config, token_manager, checksums))
+    logger.info(f"------Token requests so far: {token_manager.token_fetches}------")
+
+    return check_download_status(list_of_products, config['tmp_storage_area'])
@@ -0,0 +1,98 @@
+'''
+Backfill of a collection over a past time range, e.g. to catch up after an
+outage or to seed a new mission.
+
+The range is split into the same windows the live query loop walks
+(time_window minutes long, starting every time_step minutes), which are
+queried concurrently by a pool of workers. A rate limiter spaces the OData
+requests of all workers, including the nextLink pages of a window. Each
+window is recorded in the sync state database (see lib/sync_state.py), so a
+restarted backfill only queries the windows that have not finished, and
+the failed ones are also retried by the live loop.
+'''
+
+import concurrent.futures
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from lib.utils import init_logging
+from lib.sync_state import FINISHED
+
+logger = init_logging()
+
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+def parse_timestamp(timestamp):
+    return datetime.strptime(timestamp, TIMESTAMP_FORMAT).replace(tzinfo=timezone.utc)
+
+def format_timestamp(dt):
+    return dt.strftime(TIMESTAMP_FORMAT)
+
+def split_into_windows(start_dt, end_dt, time_window, time_step):
+    '''
+    Returns the (start, end) timestamps of the windows time_window minutes
+    long, starting every time_step minutes from start_dt, that end by end_dt.
+    A last, shorter window ends at end_dt if the full windows stop short of it.
+    '''
+    windows = []
+    window_start = start_dt
+    covered_until = start_dt
+    while window_start + timedelta(minutes=time_window) <= end_dt:
+        covered_until = window_start + timedelta(minutes=time_window)
+        windows.append((format_timestamp(window_start), format_timestamp(covered_until)))
+        window_start += timedelta(minutes=time_step)
+    if covered_until < end_dt and window_start < end_dt:
+        windows.append((format_timestamp(window_start), format_timestamp(end_dt)))
+    return windows
+
+class RateLimiter:
+    '''
+    Spaces calls to wait() by at least 1 / requests_per_second seconds
+    across all threads. No limit if requests_per_second is not set.
+    '''
+
+    def __init__(self, requests_per_second=None):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self.next_time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+def run_backfill(collection, windows, query_window, state, workers=4):
+    '''
+    Query the windows of a collection that have not finished yet, workers
+    at a time, recording each in state (a SyncState). query_window(start_timestamp,
+    end_timestamp) returns whether the whole window was queried.
+
+    Returns the windows that failed.
+    '''
+    finished = set(state.get_windows(collection, FINISHED))
+    pending = [window for window in windows if window not in finished]
+    logger.info(f"------Backfilling {collection}: {len(pending)} of {len(windows)} windows left, {workers} workers------")
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(query_window, *window): window for window in pending}
+        for done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            window = futures[future]
+            try:
+                complete = future.result()
+            except Exception as e:
+                logger.error(f"------Window {window[0]} - {window[1]} raised an error: {e}------")
+                complete = False
+            state.record_window(collection, window, complete)
+            if not complete:
+                failed.append(window)
+            if done % 100 == 0:
+                logger.info(f"------Backfilled {done} of {len(pending)} windows of {collection}------")
+
+    logger.info(f"------Backfill of {collection} done, {len(failed)} windows failed------")
+    return failed
@@ -1,9 +1,10 @@
 from lib.utils import load_values_from_config, init_logging
-from lib.integrity_check import check_extracted_integrity
-import requests
+from lib.extraction import extract_product
+from lib.stream_download import download_resumable
+from lib.token_manager import TokenManager
+from lib.http_session import get_download_session
 import os
 import zipfile
-import time
 
 (
     username,
@@ -17,77 +18,35 @@ import time
 
 logger = init_logging()
 
-# Init access token
-access_token = None
-token_expiry = 0
-refresh_token = None
+# One token for the whole run, renewed shortly before it expires
+token_manager = TokenManager(username, password)
 
 def get_access_token():
-    global access_token, token_expiry, refresh_token
-
-    # If token exists and is still valid, return it
-    # REMOVED since it seems to be better to refresh before each download.
-    # if access_token and time.time() < token_expiry - 60:  # Refresh 1 minute before expiry
-    #     return access_token
-
-    # Define the URL and payload data
-    url = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
-
-    if refresh_token:
-        payload = {
-            "client_id": "cdse-public",
-            "grant_type": "refresh_token",
-            "refresh_token": refresh_token
-        }
-    else:
-        payload = {
-            'grant_type': 'password',
-            'username': username,
-            'password': password,
-            'client_id': 'cdse-public'
-        }
-
-    # Define the headers
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    # Make the POST request
-    response = requests.post(url, data=payload, headers=headers)
-
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        access_token = response.json()['access_token']
-        token_expiry = time.time() + response.json()['expires_in']
-        refresh_token = response.json()['refresh_token']
-        return access_token
-    else:
-        # Raise an exception with the error message if the request fails
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+    '''
+    Returns a valid access token, fetching a new one only when the current
+    one is about to expire.
+    '''
+    return token_manager.get_token()
 
-def download_product(product_id, product_title, access_token):
+def download_product(product_id, product_title):
     '''
-    Download product from Copernicus Data Space Ecosystem
+    Download product from Copernicus Data Space Ecosystem.
+    The product is streamed to disk rather than held in memory and an
+    unfinished download is resumed. An access token that expires during
+    the download is renewed transparently.
     '''
     logger.info(f"------Downloading product: {product_title}-------")
-    session = requests.Session()
-    session.headers.update({'Authorization': f'Bearer {access_token}'})
+    session = get_download_session(token_manager, pool_size=1)
     url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
-    response = session.get(url, allow_redirects=False)
-
-    while response.status_code in (301, 302, 303, 307):
-        url = response.headers['Location']
-        response = session.get(url, allow_redirects=False)
-
-    file = session.get(url, verify=False, allow_redirects=True)
     output_filepath = os.path.join(output_dir, product_title)
+    download_resumable(session, url, f"{output_filepath}.zip")
 
-    with open(f"{output_filepath}.zip", 'wb') as p:
-        p.write(file.content)
-
-def unzip_and_store(product_title, storage_path):
+def unzip_and_store(product_title, storage_path, pool=None, workers=None):
     '''
     Unzip downloaded product and store to a specified directory.
+    The product only appears in the directory once all its files passed the
+    integrity checks. If pool (a ProcessPoolExecutor of workers processes)
+    is given, the files are extracted in parallel by its workers.
     The zip file is subsequently deleted.
     '''
     zip_filepath = os.path.join(output_dir, f"{product_title}.zip")
@@ -99,17 +58,18 @@ def unzip_and_store(product_title, storage_path):
         return
 
     try:
-        with zipfile.ZipFile(zip_filepath, "r") as zip_file:
-            zip_file.extractall(storage_path)
-        # Integrity check of the extracted files
-        check_extracted_integrity(zip_filepath, storage_path)
+        # Extract and check the integrity of the extracted files in one pass
+        failed_checks = extract_product(zip_filepath, storage_path, pool, workers)
         os.remove(zip_filepath)
+        if failed_checks:
+            logger.error(f"------Failed to extract {len(failed_checks)} files from {zip_filepath}, zip file has been removed------")
+            return False
         logger.info(f"------Extracted and deleted zip file: {zip_filepath}------")
         return True
 
     except zipfile.BadZipFile:
         os.remove(zip_filepath)
-        logger.error(f"------Failed to extract: {zip_filepath}. Corrupt (Non-valid) zip file has been removed------") # Most likely due to download taking more than 10 mins (token expires)
+        logger.error(f"------Failed to extract: {zip_filepath}. Corrupt (Non-valid) zip file has been removed------")
 
     except Exception as e:
         os.remove(zip_filepath)
@@ -0,0 +1,363 @@
+'''
+The SQLite queue of products waiting to be downloaded.
+
+sync_query.py adds products to the queue and sync_download.py takes them
+off it. This module owns the schema and every query on it:
+
+- the table is indexed on id (every update and delete filters on it) and
+  on size (the size lanes), so queue operations stay fast with a backlog of
+  millions of rows,
+- the database is in WAL mode with a busy timeout, so the query and
+  download jobs can use it at the same time,
+- each process keeps one connection per database, shared by its threads,
+- inserts, updates and deletes are done in bulk, one transaction per call.
+
+Several download workers, on one or more nodes, can share a queue. A worker
+claims a batch of products (claim_products), which leases them to it until
+lease_expires, renews the lease while it is downloading them (LeaseKeeper)
+and gives them back when it fails or stops. Products whose lease has
+expired, e.g. because their worker died, can be claimed again. WAL mode
+needs the database on a local file system; for workers on several nodes
+sharing it over a network file system use journal_mode DELETE.
+'''
+
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+BUSY_TIMEOUT = 30 # Seconds to wait for the other job to finish writing
+MAX_PARAMETERS = 900 # Stay below SQLite's limit on query parameters
+LEASE_SECONDS = 900
+
+_connections = {}
+_lock = threading.RLock()
+
+def create_download_queue_table(cur):
+    '''
+    Create the download queue table and its indexes if they do not exist,
+    and add the columns introduced since older queue databases were created.
+    '''
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS products (
+            name TEXT PRIMARY KEY,
+            id TEXT,
+            attempts INTEGER DEFAULT 0,
+            size INTEGER,
+            checksum_algorithm TEXT,
+            checksum TEXT,
+            lease_owner TEXT,
+            lease_expires REAL
+        )
+    """)
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(products)")]
+    for column, column_type in [
+        ('size', 'INTEGER'), ('checksum_algorithm', 'TEXT'), ('checksum', 'TEXT'),
+        ('lease_owner', 'TEXT'), ('lease_expires', 'REAL')
+    ]:
+        if column not in columns:
+            cur.execute(f"ALTER TABLE products ADD COLUMN {column} {column_type}")
+    cur.execute("CREATE INDEX IF NOT EXISTS products_id ON products (id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS products_size ON products (size)")
+    cur.execute("CREATE INDEX IF NOT EXISTS products_lease_expires ON products (lease_expires)")
+
+def get_connection(db_path, journal_mode='WAL'):
+    '''
+    Returns this process's connection to the queue at db_path, creating the
+    schema on first use. The connection is shared by the threads of the
+    process, so use it while holding the module lock (see the functions below).
+    journal_mode only applies to the first call for a database.
+    '''
+    key = (os.getpid(), db_path)
+    with _lock:
+        if key not in _connections:
+            conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+            conn.execute(f"PRAGMA journal_mode={journal_mode}")
+            conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT * 1000}")
+            # Durable at every checkpoint, which is enough for a queue that can be rebuilt by querying
+            conn.execute("PRAGMA synchronous=NORMAL")
+            with conn:
+                create_download_queue_table(conn.cursor())
+            _connections[key] = conn
+        return _connections[key]
+
+def batches(values, size=MAX_PARAMETERS):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def add_products(db_path, products):
+    """
+    Add products to the queue, skipping those already in it.
+
+    Parameters:
+        products (iterable of tuples): (name, id, size, checksum_algorithm, checksum) of each product.
+        db_path (str): Path to the SQLite database.
+
+    Returns:
+        int: Number of products added.
+    """
+    conn = get_connection(db_path)
+    with _lock, conn:
+        before = conn.total_changes
+        conn.executemany("""
+            INSERT OR IGNORE INTO products (name, id, attempts, size, checksum_algorithm, checksum)
+            VALUES (?, ?, 0, ?, ?, ?)
+        """, products)
+        return conn.total_changes - before
+
+def update_number_of_attempts(failures, db_path, retry_delay=0):
+    """
+    Increments the 'attempts' value by 1 for each product in the failures list
+    and releases their leases, so any worker can try them again once
+    retry_delay seconds have passed (claim_products skips them until then).
+
+    Parameters:
+        failures (list of tuples): (id, name) of the products to update.
+        db_path (str): Path to the SQLite database.
+        retry_delay (float): Seconds before the products can be claimed again.
+    """
+    if not failures:
+        return  # Nothing to do
+
+    retry_after = time.time() + retry_delay if retry_delay else None
+    conn = get_connection(db_path)
+    with _lock, conn:
+        conn.executemany(
+            "UPDATE products SET attempts = attempts + 1, lease_owner = NULL, lease_expires = ? WHERE id = ?",
+            [(retry_after, id) for id, name in failures]
+        )
+
+def remove_repeated_failures_from_queue(failures, db_path, limit_download_attempts):
+    """
+    Removes products from the queue if they have failed limit_download_attempts or more times.
+
+    Parameters:
+        failures (list of tuples): (id, name) of the products to check.
+        db_path (str): Path to the SQLite database.
+    """
+    if not failures:
+        return  # Nothing to do
+
+    conn = get_connection(db_path)
+    with _lock, conn:
+        conn.executemany(
+            "DELETE FROM products WHERE id = ? AND attempts >= ?",
+            [(id, limit_download_attempts) for id, name in failures]
+        )
+
+def remove_products_from_queue(products, db_path):
+    """
+    Removes products from the queue based on their ids.
+
+    Parameters:
+        products (list of tuples): (id, name) of the products to remove.
+        db_path (str): Path to the SQLite database.
+    """
+    if not products:
+        return  # Nothing to do
+
+    conn = get_connection(db_path)
+    with _lock, conn:
+        conn.executemany("DELETE FROM products WHERE id = ?", [(id,) for id, name in products])
+
+def get_products_to_download(db_path, limit, min_size=None, max_size=None, exclude_ids=()):
+    """
+    Retrieves the first `limit` product ids and names from the queue.
+
+    Parameters:
+        db_path (str): Path to the SQLite database.
+        limit (int): Number of products to retrieve.
+        min_size (int): Only products of at least this many bytes (or of unknown size).
+        max_size (int): Only products of known size below this many bytes.
+        exclude_ids (iterable of str): Product ids to skip, e.g. those already downloading.
+
+    Returns:
+        list of tuples: Each tuple contains (id, name) of a product to download,
+        the largest products first.
+    """
+    conditions = []
+    parameters = []
+    if min_size is not None:
+        conditions.append("(size IS NULL OR size >= ?)")
+        parameters.append(min_size)
+    if max_size is not None:
+        conditions.append("size < ?")
+        parameters.append(max_size)
+    exclude_ids = list(exclude_ids)
+    if exclude_ids:
+        conditions.append(f"id NOT IN ({', '.join('?' * len(exclude_ids))})")
+        parameters.extend(exclude_ids)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    conn = get_connection(db_path)
+    with _lock:
+        # Oldest products first, then the largest of those first so the
+        # longest transfers start early and do not hold up the end of the batch
+        return conn.execute(f"""
+            SELECT id, name FROM (
+                SELECT id, name, size FROM products
+                {where}
+                ORDER BY ROWID ASC
+                LIMIT ?
+            )
+            ORDER BY size IS NULL DESC, size DESC
+        """, (*parameters, limit)).fetchall()
+
+def get_product_checksums(products, db_path):
+    """
+    Retrieves the published checksums of products in the queue.
+
+    Parameters:
+        products (list of tuples): (id, name) of the products.
+        db_path (str): Path to the SQLite database.
+
+    Returns:
+        dict: Product id to (algorithm, value), for products with a known checksum.
+    """
+    checksums = {}
+    conn = get_connection(db_path)
+    with _lock:
+        for ids in batches(id for id, name in products):
+            rows = conn.execute(f"""
+                SELECT id, checksum_algorithm, checksum FROM products
+                WHERE checksum IS NOT NULL AND id IN ({', '.join('?' * len(ids))})
+            """, ids)
+            checksums.update({id: (algorithm, checksum) for id, algorithm, checksum in rows})
+    return checksums
+
+def get_worker_id():
+    '''
+    Returns the name this process holds leases under, unique across nodes.
+    '''
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def claim_products(db_path, owner, limit, lease_seconds=LEASE_SECONDS, min_size=None, max_size=None):
+    """
+    Atomically claims up to `limit` of the oldest products not leased to
+    another worker, leasing them to owner for lease_seconds.
+
+    Parameters:
+        db_path (str): Path to the SQLite database.
+        owner (str): Worker claiming the products, see get_worker_id.
+        limit (int): Number of products to claim.
+        lease_seconds (float): How long the products are leased for, unless renewed.
+        min_size (int): Only products of at least this many bytes (or of unknown size).
+        max_size (int): Only products of known size below this many bytes.
+
+    Returns:
+        list of tuples: (id, name) of the claimed products, the largest first.
+    """
+    now = time.time()
+    conditions = ["(lease_expires IS NULL OR lease_expires < ?)"]
+    parameters = [now]
+    if min_size is not None:
+        conditions.append("(size IS NULL OR size >= ?)")
+        parameters.append(min_size)
+    if max_size is not None:
+        conditions.append("size < ?")
+        parameters.append(max_size)
+
+    conn = get_connection(db_path)
+    with _lock:
+        # Take the write lock before reading, so no other worker can claim the same rows
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(f"""
+                SELECT id, name, size FROM products
+                WHERE {' AND '.join(conditions)}
+                ORDER BY ROWID ASC
+                LIMIT ?
+            """, (*parameters, limit)).fetchall()
+            conn.executemany(
+                "UPDATE products SET lease_owner = ?, lease_expires = ? WHERE id = ?",
+                [(owner, now + lease_seconds, id) for id, name, size in rows]
+            )
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+    # Largest products first (unknown sizes before all), as get_products_to_download
+    rows.sort(key=lambda row: (row[2] is not None, -(row[2] or 0)))
+    return [(id, name) for id, name, size in rows]
+
+def renew_leases(db_path, owner, ids, lease_seconds=LEASE_SECONDS):
+    """
+    Extends the leases owner holds on the products with the given ids.
+    """
+    conn = get_connection(db_path)
+    with _lock, conn:
+        conn.executemany(
+            "UPDATE products SET lease_expires = ? WHERE id = ? AND lease_owner = ?",
+            [(time.time() + lease_seconds, id, owner) for id in ids]
+        )
+
+def release_products(db_path, owner, ids):
+    """
+    Gives products owner has claimed back to the queue, without counting an attempt.
+    """
+    conn = get_connection(db_path)
+    with _lock, conn:
+        conn.executemany(
+            "UPDATE products SET lease_owner = NULL, lease_expires = NULL WHERE id = ? AND lease_owner = ?",
+            [(id, owner) for id in ids]
+        )
+
+class LeaseKeeper:
+    '''
+    Claims products for this worker and renews their leases in a background
+    thread until they are reported done, so products that take longer than
+    lease_seconds to download are not claimed by another worker meanwhile.
+    '''
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS, owner=None):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.owner = owner or get_worker_id()
+        self.ids = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._renew, name='lease-keeper', daemon=True)
+        self._thread.start()
+
+    def claim(self, limit, min_size=None, max_size=None):
+        products = claim_products(self.db_path, self.owner, limit, self.lease_seconds, min_size, max_size)
+        with self._lock:
+            self.ids.update(id for id, name in products)
+        return products
+
+    def done(self, products):
+        '''
+        Stop renewing the leases of products that were reported.
+        '''
+        with self._lock:
+            self.ids.difference_update(id for id, name in products)
+
+    def release(self, products):
+        '''
+        Give products back to the queue unfinished, without counting an attempt.
+        '''
+        self.done(products)
+        release_products(self.db_path, self.owner, [id for id, name in products])
+
+    def _renew(self):
+        # Renew well before the leases run out
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                ids = list(self.ids)
+            if ids:
+                renew_leases(self.db_path, self.owner, ids, self.lease_seconds)
+
+    def close(self):
+        '''
+        Stop renewing and give the products still held back to the queue.
+        '''
+        self._stop.set()
+        self._thread.join()
+        with self._lock:
+            ids = list(self.ids)
+            self.ids.clear()
+        if ids:
+            release_products(self.db_path, self.owner, ids)
@@ -0,0 +1,142 @@
+'''
+Extraction of product archives, optionally spread over a process pool.
+
+Products are extracted into a hidden staging directory next to their final
+location and only moved into the archive tree once every member has passed
+its integrity check, so a half-extracted product never appears there.
+
+Decompression is CPU-bound, so either the members of one product are spread
+over the pool (extract_product with a pool, for large products with many
+members such as Sentinel-2 SAFE archives) or whole products are extracted in
+parallel, one per worker process (extract_products).
+'''
+
+import concurrent.futures
+import os
+import shutil
+import time
+import zipfile
+from lib.utils import init_logging
+from lib.integrity_check import extract_member_and_verify
+
+logger = init_logging()
+
+def get_staging_dir(zip_filepath, storage_path):
+    '''
+    Returns the hidden directory a product is extracted to before it is moved into storage_path.
+    '''
+    product_name = os.path.splitext(os.path.basename(zip_filepath))[0]
+    return os.path.join(storage_path, f".{product_name}.extracting")
+
+def extract_members(zip_filepath, staging_dir, member_names):
+    '''
+    Extract and verify the given members of a ZIP archive into staging_dir.
+    Runs in a worker process, so the archive is opened here.
+    Returns a dictionary of the members that failed and why.
+    '''
+    failed_checks = {}
+    with zipfile.ZipFile(zip_filepath, "r") as zip_file:
+        for member_name in member_names:
+            info = zip_file.getinfo(member_name)
+            reason = extract_member_and_verify(zip_file, info, staging_dir)
+            if reason:
+                failed_checks[member_name] = reason
+    return failed_checks
+
+def split_members(infos, parts):
+    '''
+    Split ZIP members into at most `parts` groups of similar uncompressed size,
+    placing the largest members first.
+    '''
+    groups = [[] for _ in range(max(min(parts, len(infos)), 1))]
+    sizes = [0] * len(groups)
+    for info in sorted(infos, key=lambda info: info.file_size, reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(info.filename)
+        sizes[smallest] += info.file_size
+    return [group for group in groups if group]
+
+def place_extracted_product(staging_dir, storage_path):
+    '''
+    Move the extracted top-level entries (e.g. PRODUCT.SAFE) from staging_dir
+    into storage_path. Renames within the same filesystem are atomic, and an
+    earlier copy of the product is only deleted once the new one is in place,
+    so the product never disappears from storage_path.
+    '''
+    for entry in os.listdir(staging_dir):
+        destination = os.path.join(storage_path, entry)
+        source = os.path.join(staging_dir, entry)
+        if os.path.isdir(destination):
+            # Move the earlier copy aside (hidden, like the staging directory)
+            old_copy = os.path.join(storage_path, f".{entry}.old")
+            shutil.rmtree(old_copy, ignore_errors=True)
+            os.rename(destination, old_copy)
+            os.rename(source, destination)
+            shutil.rmtree(old_copy)
+        else:
+            os.replace(source, destination)
+    os.rmdir(staging_dir)
+
+def extract_product(zip_filepath, storage_path, pool=None, workers=None):
+    '''
+    Extract a product archive into storage_path, verifying every member.
+
+    If pool (a ProcessPoolExecutor) is given, the members are split into one
+    group per worker, workers being the size of the pool (os.cpu_count() if
+    not given, as for the pool itself). The product only appears in storage_path if every member passed
+    its checks. Returns a dictionary of the members that failed and why.
+    '''
+    start = time.monotonic()
+    staging_dir = get_staging_dir(zip_filepath, storage_path)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    with zipfile.ZipFile(zip_filepath, "r") as zip_file:
+        infos = zip_file.infolist()
+
+    failed_checks = {}
+    try:
+        if pool is None:
+            failed_checks = extract_members(zip_filepath, staging_dir, [info.filename for info in infos])
+        else:
+            futures = [
+                pool.submit(extract_members, zip_filepath, staging_dir, member_names)
+                for member_names in split_members(infos, workers or os.cpu_count() or 1)
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                failed_checks.update(future.result())
+
+        if failed_checks:
+            logger.error(f"------Integrity check failed for files: {sorted(failed_checks)}------")
+        else:
+            place_extracted_product(staging_dir, storage_path)
+            logger.info(f"------Passed all integrity checks, stored in {storage_path} ({time.monotonic() - start:.2f}s)------")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return failed_checks
+
+def extract_products(products, pool):
+    '''
+    Extract several product archives in parallel, one product per worker process.
+
+    Parameters:
+        products (list of tuples): (zip_filepath, storage_path) of each product.
+        pool (ProcessPoolExecutor): Pool to extract the products in.
+
+    Returns:
+        dict: zip_filepath to the dictionary of members that failed (empty on success).
+    '''
+    futures = {
+        pool.submit(extract_product, zip_filepath, storage_path): zip_filepath
+        for zip_filepath, storage_path in products
+    }
+    results = {}
+    for future in concurrent.futures.as_completed(futures):
+        zip_filepath = futures[future]
+        try:
+            results[zip_filepath] = future.result()
+        except Exception as e:
+            logger.error(f"------Unexpected error while extracting {zip_filepath}: {e}------")
+            results[zip_filepath] = {'': str(e)}
+    return results
@@ -0,0 +1,220 @@
+'''
+Parsing of Sentinel product names, for all missions.
+
+Gives the platform, sensing date, S1 acquisition mode, S2 tile, the ESA
+product type used to look up our product type (S3/S5) and the short name
+used to recognise a product across reprocessings.
+
+parse_filename parses one name. parse_filenames parses a whole page of names
+at once: the names are laid out as a numpy character matrix and every field
+is sliced out of it at its fixed position per mission, so there is no
+Python work per name. Names that do not follow the usual layout are passed
+to parse_filename instead. The product types table is read once per CSV file.
+'''
+
+import functools
+import re
+import numpy as np
+import pandas as pd
+
+FIELDS = ['mission', 'platform', 'date', 'mode', 'tile', 'esa_product_type', 'short_name']
+# Start and end of the sensing date (YYYYMMDD) in the name, per mission
+DATE_POSITIONS = {'S1': (17, 25), 'S2': (11, 19), 'S3': (16, 24), 'S5': (20, 28)}
+# Start and end of the ESA product type in the name (S1 and S2 are split on '_' instead)
+PRODUCT_TYPE_POSITIONS = {'S3': (4, 15), 'S5': (9, 19)}
+S1_MODE_POSITION = (4, 6)
+S1_PRODUCT_TYPE_POSITION = (4, 11)
+S1_FALLBACK_PRODUCT_TYPE_POSITION = (4, 14)
+S2_PRODUCT_TYPE_POSITION = (4, 10)
+S2_TILE_POSITION = (39, 44)
+# Short names end with the sensing start and stop times, S2 names only have one
+SHORT_NAME_PATTERN = re.compile(r'^(.*?\d{8}T\d{6}_\d{8}T\d{6})')
+S2_SHORT_NAME_PATTERN = re.compile(r'^(.*?\d{8}T\d{6})')
+SHORT_NAME_MISSIONS = ('S1', 'S3', 'S5', 'S6')
+TILE_PATTERN = re.compile(r'_T(\d{2}[A-Z]{3})_')
+
+@functools.lru_cache(maxsize=None)
+def get_product_types(product_metadata_csv):
+    '''
+    Returns {ESA product type: our product type} from the product types CSV,
+    read once per file.
+    '''
+    product_metadata_df = pd.read_csv(product_metadata_csv, dtype=str)
+    product_metadata_df = product_metadata_df.dropna(subset=['Alias (ESA product type)', 'product_type'])
+    product_metadata_df = product_metadata_df[product_metadata_df['product_type'] != '']
+    # The first row of an alias wins, as in get_product_metadata
+    product_metadata_df = product_metadata_df.drop_duplicates(subset='Alias (ESA product type)')
+    return dict(zip(product_metadata_df['Alias (ESA product type)'], product_metadata_df['product_type']))
+
+def get_short_name(filename):
+    '''
+    Returns the short name of a product name: the name up to the sensing
+    start and stop times (S1, S3, S5, S6) or the sensing time (S2).
+    '''
+    mission = filename[:2]
+    if mission in SHORT_NAME_MISSIONS:
+        match = SHORT_NAME_PATTERN.match(filename)
+    elif mission == 'S2':
+        match = S2_SHORT_NAME_PATTERN.match(filename)
+    else:
+        return filename
+    return match.group(1) if match else filename
+
+def parse_filename(filename):
+    '''
+    Returns a dictionary of the FIELDS of one product name, None where a
+    field does not apply to the mission.
+    '''
+    mission = filename[:2]
+    parts = filename.split('_')
+    parsed = dict.fromkeys(FIELDS)
+    parsed.update(mission=mission, platform=parts[0], short_name=get_short_name(filename))
+
+    if mission in DATE_POSITIONS:
+        start, end = DATE_POSITIONS[mission]
+        parsed['date'] = filename[start:end] or None
+
+    if mission == 'S1':
+        parsed['mode'] = filename[slice(*S1_MODE_POSITION)]
+        product_type = '_'.join(parts[1:3])
+        if product_type.startswith('S'):
+            product_type = filename[slice(*S1_FALLBACK_PRODUCT_TYPE_POSITION)]
+        parsed['esa_product_type'] = product_type
+    elif mission == 'S2':
+        parsed['esa_product_type'] = parts[1] if len(parts) > 1 else None
+        match = TILE_PATTERN.search(filename)
+        parsed['tile'] = match.group(1) if match else None
+    elif mission in PRODUCT_TYPE_POSITIONS:
+        start, end = PRODUCT_TYPE_POSITIONS[mission]
+        parsed['esa_product_type'] = filename[start:end]
+
+    return parsed
+
+def get_char_field(chars, start, end):
+    '''
+    Returns columns start to end of the character matrix as an array of strings.
+    '''
+    return np.ascontiguousarray(chars[:, start:end]).view(f'U{end - start}').ravel()
+
+def parse_filenames(filenames):
+    '''
+    Parse product names in one batch.
+
+    Returns a dictionary of the FIELDS plus year, month and day, each an
+    array with one string per name (empty where a field does not apply to
+    the mission), e.g. pd.DataFrame(parse_filenames(names)).
+    '''
+    names = list(filenames)
+    # One row per name, one UCS-4 code point per character, padded with zeros
+    width = max(max(map(len, names), default=0), 64)
+    chars = np.array(names, dtype=f'U{width}').view(np.uint32).reshape(len(names), width)
+
+    def char_is(rows, position, character):
+        return rows[:, position] == ord(character)
+
+    mission = get_char_field(chars, 0, 2)
+    date = np.zeros(len(names), dtype='U8')
+    mode = np.zeros(len(names), dtype='U2')
+    tile = np.zeros(len(names), dtype='U5')
+    esa_product_type = np.zeros(len(names), dtype='U16')
+    short_name = np.zeros(len(names), dtype=f'U{width}')
+    # Names whose fields are all where they are expected
+    regular = char_is(chars, 3, '_') & np.isin(mission, list(DATE_POSITIONS))
+
+    for mission_name, (start, end) in DATE_POSITIONS.items():
+        indices = np.flatnonzero(mission == mission_name)
+        if not len(indices):
+            continue
+        rows = chars[indices]
+        date[indices] = get_char_field(rows, start, end)
+        # The sensing time follows the date, the short name ends after it (S2)
+        # or after the sensing stop time that follows it
+        short_name_end = end + 7 if mission_name == 'S2' else end + 23
+        layout = char_is(rows, end, 'T') & (char_is(rows, short_name_end, '_') | char_is(rows, short_name_end, '\0'))
+        short_name[indices] = get_char_field(rows, 0, short_name_end)
+
+        if mission_name == 'S1':
+            mode[indices] = get_char_field(rows, *S1_MODE_POSITION)
+            fallback = char_is(rows, 4, 'S')
+            # e.g. IW_GRDH from S1A_IW_GRDH_1SDV_..., but not IW_SLC_ from S1A_IW_SLC__1SDV_...
+            layout &= fallback | (char_is(rows, 6, '_') & char_is(rows, 11, '_') & ~char_is(rows, 10, '_'))
+            esa_product_type[indices] = np.where(
+                fallback,
+                get_char_field(rows, *S1_FALLBACK_PRODUCT_TYPE_POSITION),
+                get_char_field(rows, *S1_PRODUCT_TYPE_POSITION)
+            )
+        elif mission_name == 'S2':
+            tile_start, tile_end = S2_TILE_POSITION
+            layout &= (
+                char_is(rows, 10, '_') & char_is(rows, tile_start - 2, '_')
+                & char_is(rows, tile_start - 1, 'T') & char_is(rows, tile_end, '_')
+            )
+            esa_product_type[indices] = get_char_field(rows, *S2_PRODUCT_TYPE_POSITION)
+            tile[indices] = get_char_field(rows, tile_start, tile_end)
+        else:
+            esa_product_type[indices] = get_char_field(rows, *PRODUCT_TYPE_POSITIONS[mission_name])
+
+        regular[indices] &= layout
+
+    date_chars = date.view(np.uint32).reshape(len(names), 8)
+    parsed = {
+        'mission': mission,
+        'platform': get_char_field(chars, 0, 3),
+        'date': date,
+        'year': get_char_field(date_chars, 0, 4),
+        'month': get_char_field(date_chars, 4, 6),
+        'day': get_char_field(date_chars, 6, 8),
+        'mode': mode,
+        'tile': tile,
+        'esa_product_type': esa_product_type,
+        'short_name': short_name,
+    }
+
+    # Names in an unexpected layout, or of missions without fixed positions
+    irregular = np.flatnonzero(~regular)
+    if len(irregular):
+        # Their fields may be longer than the fixed width ones
+        parsed = {field: values.astype(object) for field, values in parsed.items()}
+        for i in irregular:
+            fields = parse_filename(names[i])
+            date = fields['date'] or ''
+            fields.update(year=date[:4], month=date[4:6], day=date[6:8])
+            for field, value in fields.items():
+                parsed[field][i] = value or ''
+
+    return parsed
+
+def get_short_names(filenames):
+    '''
+    Returns the short name of each product name, see get_short_name.
+    '''
+    return parse_filenames(filenames)['short_name'].tolist()
+
+def predict_base_paths(filenames, root_path, product_metadata_csv):
+    '''
+    Returns the storage directory of each product name:
+        root_path/platform/year/month/day/              (S2)
+        root_path/platform/year/month/day/mode/         (S1)
+        root_path/platform/year/month/day/product_type/ (S3, S5)
+    or None where it cannot be predicted (unknown mission or product type).
+    '''
+    parsed = parse_filenames(filenames)
+    if not len(parsed['mission']):
+        return []
+    product_types = get_product_types(product_metadata_csv)
+    mission = parsed['mission'].astype(str)
+
+    # Only look up each distinct product type once
+    esa_product_types, inverse = np.unique(parsed['esa_product_type'].astype(str), return_inverse=True)
+    product_type = np.array([product_types.get(esa_product_type, '') for esa_product_type in esa_product_types], dtype=str)[inverse.ravel()]
+
+    last_directory = np.where(mission == 'S1', parsed['mode'].astype(str), product_type)
+    last_directory = np.where(mission == 'S2', '', np.char.add(last_directory, '/'))
+
+    path = np.char.add(root_path, parsed['platform'].astype(str))
+    for field in ('year', 'month', 'day'):
+        path = np.char.add(np.char.add(path, '/'), parsed[field].astype(str))
+    path = np.char.add(np.char.add(path, '/'), last_directory)
+
+    valid = (parsed['date'].astype(str) != '') & ((mission == 'S2') | (last_directory != '/'))
+    return [p if ok else None for p, ok in zip(path.tolist(), valid.tolist())]
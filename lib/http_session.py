@@ -0,0 +1,175 @@
+'''
+Long-lived, pooled HTTP sessions: one shared by all download workers and
+one for catalogue queries (see get_query_session).
+
+Connections to the catalogue and download hosts are kept alive and reused
+across products, resolved download-host redirects are remembered for the
+lifetime of the token they were resolved with, and every request reports
+how long it spent connecting, waiting for the first byte and transferring.
+'''
+
+import threading
+import time
+from urllib.parse import urlsplit, urlunsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from lib.token_manager import TokenAuth
+from lib.utils import init_logging
+
+logger = init_logging()
+
+_timing = threading.local()
+_session = None
+_query_session = None
+_session_lock = threading.Lock()
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        _timing.connect = getattr(_timing, 'connect', 0.0) + time.monotonic() - start
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start = time.monotonic()
+        super().connect()
+        _timing.connect = getattr(_timing, 'connect', 0.0) + time.monotonic() - start
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedHTTPAdapter(HTTPAdapter):
+    '''
+    HTTPAdapter whose connections record the time spent in connect()
+    (TCP and TLS handshake). Reused keep-alive connections record nothing.
+    '''
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': TimedHTTPConnectionPool,
+            'https': TimedHTTPSConnectionPool,
+        }
+
+class RequestTiming:
+    '''
+    Connect, time to first byte and transfer time of one (possibly
+    redirected) request made from the current thread.
+    '''
+
+    def __init__(self, url):
+        self.url = url
+        self.start = time.monotonic()
+        self.connect = 0.0
+        self.ttfb = None
+        _timing.connect = 0.0
+
+    def headers_received(self):
+        self.connect = getattr(_timing, 'connect', 0.0)
+        self.ttfb = time.monotonic() - self.start
+
+    def finished(self, nbytes):
+        transfer = time.monotonic() - self.start - (self.ttfb or 0.0)
+        rate = nbytes / transfer / 1e6 if transfer > 0 else 0.0
+        logger.debug(f"------{self.url}: connect {self.connect:.3f}s, TTFB {self.ttfb or 0.0:.3f}s, transfer {transfer:.3f}s ({nbytes} bytes, {rate:.1f} MB/s)------")
+
+class RedirectCache:
+    '''
+    Remembers where the catalogue redirects product URLs to.
+
+    CDSE redirects catalogue.dataspace.copernicus.eu/odata/v1/Products(<id>)/$value
+    to the same path on the download host, so besides the resolved URL of
+    each product the host mapping itself is learnt and applied to products
+    that have not been resolved yet. Entries expire with the access token
+    they were resolved with.
+    '''
+
+    def __init__(self, token_manager=None):
+        self.token_manager = token_manager
+        self._urls = {}
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _expiry(self):
+        if self.token_manager is None:
+            return float('inf')
+        return self.token_manager.token_expiry
+
+    def lookup(self, url):
+        now = time.time()
+        parts = urlsplit(url)
+        with self._lock:
+            resolved_url, expiry = self._urls.get(url, (None, 0))
+            if resolved_url and now < expiry:
+                return resolved_url
+            host, expiry = self._hosts.get(parts.netloc, (None, 0))
+            if host and now < expiry:
+                return urlunsplit(parts._replace(netloc=host))
+        return None
+
+    def store(self, url, resolved_url):
+        if resolved_url == url:
+            return
+        expiry = self._expiry()
+        parts = urlsplit(url)
+        resolved_parts = urlsplit(resolved_url)
+        with self._lock:
+            self._urls[url] = (resolved_url, expiry)
+            if (parts.scheme, parts.path, parts.query) == (resolved_parts.scheme, resolved_parts.path, resolved_parts.query):
+                self._hosts[parts.netloc] = (resolved_parts.netloc, expiry)
+
+    def forget(self, url):
+        with self._lock:
+            self._urls.pop(url, None)
+            self._hosts.pop(urlsplit(url).netloc, None)
+
+def mount_adapter(session, adapter):
+    '''
+    Mount adapter for http:// and https:// URLs, closing the adapters it
+    replaces so their pooled keep-alive connections are not left open.
+    '''
+    replaced = {session.adapters.get(prefix) for prefix in ('https://', 'http://')}
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    for old_adapter in replaced:
+        if old_adapter is not None:
+            old_adapter.close()
+
+def get_download_session(token_manager, pool_size):
+    '''
+    Returns the process-wide download session, authenticated with
+    token_manager, keeping up to pool_size connections alive per host.
+    '''
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            _session.pool_size = 0
+            _session.redirect_cache = RedirectCache(token_manager)
+        if pool_size > _session.pool_size:
+            mount_adapter(_session, TimedHTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0))
+            _session.pool_size = pool_size
+        _session.auth = TokenAuth(token_manager)
+        _session.redirect_cache.token_manager = token_manager
+        return _session
+
+def get_query_session(pool_size=1):
+    '''
+    Returns the process-wide session for catalogue queries, which need no
+    token, keeping up to pool_size connections alive per host. Shared by
+    every collection queried by the process.
+    '''
+    global _query_session
+    with _session_lock:
+        if _query_session is None:
+            _query_session = requests.Session()
+            _query_session.pool_size = 0
+        if pool_size > _query_session.pool_size:
+            mount_adapter(_query_session, HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+            _query_session.pool_size = pool_size
+        return _query_session
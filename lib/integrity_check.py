@@ -1,28 +1,74 @@
 """
+Integrity checks of extracted products.
+
 TO DO:
 [x] MD5 checksum check
+[x] CRC32 check against the zip central directory
+[x] BLAKE2 checksum check
 [x] Filesize comparison
 [] Timestamp verification
 """
 
 from lib.utils import init_logging
+import concurrent.futures
 import hashlib
+import mmap
 import zipfile
+import zlib
 import os
 import datetime
 import time
-import sys
 
 logger = init_logging()
 
-def get_file_checksum(filepath):
-    """Returns the MD5 checksum of a file."""
-    md5_check = hashlib.md5()
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+
+# Integrity modes:
+#   crc32  - CRC32 of the extracted files against the CRCs stored in the
+#            zip's central directory, nothing in the zip is decompressed
+#   md5    - MD5 of the extracted files against MD5 of the zip members
+#   blake2 - as md5, with BLAKE2b
+INTEGRITY_MODES = ('crc32', 'md5', 'blake2')
+DEFAULT_INTEGRITY_MODE = 'crc32'
+
+class CRC32:
+    """hashlib-like wrapper around zlib.crc32."""
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return f"{self.value:08x}"
+
+def new_checksum(mode):
+    """Returns a hash object for an integrity mode."""
+    if mode == 'crc32':
+        return CRC32()
+    if mode == 'md5':
+        return hashlib.md5()
+    if mode == 'blake2':
+        return hashlib.blake2b()
+    raise ValueError(f"Unknown integrity mode {mode}, valid modes are {', '.join(INTEGRITY_MODES)}")
+
+def get_file_checksum(filepath, mode='md5'):
+    """
+    Returns the checksum of a file (MD5 by default).
+    The file is memory mapped and hashed in large slices, hashlib and zlib
+    release the GIL on these so files can be hashed in parallel threads.
+    """
+    checksum = new_checksum(mode)
     try:
         with open(filepath, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                md5_check.update(chunk)
-        return md5_check.hexdigest()
+            if os.fstat(f.fileno()).st_size == 0:
+                return checksum.hexdigest()
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                with memoryview(mapped) as view:
+                    for offset in range(0, len(view), HASH_BUFFER_SIZE):
+                        checksum.update(view[offset:offset + HASH_BUFFER_SIZE])
+        return checksum.hexdigest()
     except FileNotFoundError:
         return 'File not found'
     except Exception as e:
@@ -33,8 +79,12 @@ def zip_timestamp_to_unix(zip_date_time):
     dt = datetime.datetime(*zip_date_time)  # Convert to datetime object
     return int(time.mktime(dt.timetuple()))
     
-def get_zip_file_integrity_metrics(zip_filepath):
-    """Returns a dictionary of file checksums inside a ZIP archive."""
+def get_zip_file_integrity_metrics(zip_filepath, mode='md5'):
+    """
+    Returns a dictionary of file checksums inside a ZIP archive.
+    In crc32 mode the checksums come from the central directory, the other
+    modes decompress and hash every member.
+    """
     metadata = {
         "checksums": {},
         "filesizes": {},
@@ -42,57 +92,135 @@ def get_zip_file_integrity_metrics(zip_filepath):
         }
     
     with zipfile.ZipFile(zip_filepath, "r") as zip_file:
-        for file_name in zip_file.namelist():
-            with zip_file.open(file_name) as f:
-                file_data = f.read()
-                file_checksum = hashlib.md5(file_data).hexdigest()
-                file_size = zip_file.getinfo(file_name).file_size
-                # file_timestamp = zip_timestamp_to_unix(zip_file.getinfo(file_name).date_time)
-
-                metadata["checksums"][file_name]= file_checksum
-                metadata["filesizes"][file_name]= file_size
-                # metadata["timestamps"][file_name]= file_timestamp
+        for info in zip_file.infolist():
+            if info.is_dir():
+                continue
+            if mode == 'crc32':
+                file_checksum = f"{info.CRC:08x}"
+            else:
+                checksum = new_checksum(mode)
+                with zip_file.open(info) as f:
+                    for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+                        checksum.update(chunk)
+                file_checksum = checksum.hexdigest()
+            # file_timestamp = zip_timestamp_to_unix(info.date_time)
+
+            metadata["checksums"][info.filename]= file_checksum
+            metadata["filesizes"][info.filename]= info.file_size
+            # metadata["timestamps"][info.filename]= file_timestamp
     return metadata
 
-def check_extracted_integrity(zip_filepath, extracted_dir):
-    """Compares checksums of original ZIP files and extracted files."""
-    zip_metadata = get_zip_file_integrity_metrics(zip_filepath)
+def check_extracted_file(file_name, extracted_dir, zip_checksum, zip_filesize, mode):
+    """Returns the reasons an extracted file does not match its zip member."""
+    extracted_file_path = os.path.join(extracted_dir, file_name)
+
+    if not os.path.exists(extracted_file_path):
+        return [f"Missing extracted file: {extracted_file_path}"]
+
+    reasons = []
+    extracted_size = os.path.getsize(extracted_file_path)
+    # extracted_timestamp = os.stat(extracted_file_path).st_mtime
+    # TODO: need to figure out what times to compare... currently extracted_timestamp changes to the time of extraction.
+    #       Does not stay same as time of last file change
+
+    if zip_filesize != extracted_size:
+        reasons.append(f"File size mismatch: {file_name}")
+    # A file of the wrong size cannot have the right checksum, skip hashing it
+    elif zip_checksum != get_file_checksum(extracted_file_path, mode):
+        reasons.append(f"Checksum mismatch: {file_name}")
+
+    # if abs (zip_timestamps[file_name] - extracted_timestamp) > 2: # not tested yet
+    #     reasons.append(f"Timestamp mismatch: {file_name}")
+    return reasons
+
+def check_extracted_integrity(zip_filepath, extracted_dir, mode=DEFAULT_INTEGRITY_MODE, workers=None):
+    """
+    Compares checksums of original ZIP files and extracted files.
+    Extracted files are hashed in parallel by `workers` threads.
+    """
+    start = time.monotonic()
+    zip_metadata = get_zip_file_integrity_metrics(zip_filepath, mode)
     zip_checksums = zip_metadata["checksums"]
     zip_filesizes = zip_metadata["filesizes"]
-    # zip_timestamps = zip_metadata["timestamps"]
-
 
     failed_checks = set()
 
-    for file_name in zip_checksums:
-        extracted_file_path = os.path.join(extracted_dir, file_name)
-        
-        if not os.path.exists(extracted_file_path):
-            logger.info(f"------Missing extracted file: {extracted_file_path}------")
-            failed_checks.add(file_name)
-            continue
-        
-        extracted_checksum = get_file_checksum(extracted_file_path)
-        extracted_size = os.path.getsize(extracted_file_path)
-        # extracted_timestamp = os.stat(extracted_file_path).st_mtime
-        # TODO: need to figure out what times to compare... currently extracted_timestamp changes to the time of extraction.
-        #       Does not stay same as time of last file change
-
-
-        if zip_checksums[file_name] != extracted_checksum:
-            logger.info(f"------Checksum mismatch: {file_name}------")
-            failed_checks.add(file_name)
-        
-        if zip_filesizes[file_name] != extracted_size:
-            logger.info(f"------File size mismatch: {file_name}------")
-            failed_checks.add(file_name)
-
-        # if abs (zip_timestamps[file_name] - extracted_timestamp) > 2: # not tested yet
-        #     logger.info(f"------Timestamp mismatch: {file_name}------")
-        #     failed_checks.add(file_name)   
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4)) as executor:
+        futures = {
+            executor.submit(check_extracted_file, file_name, extracted_dir, zip_checksums[file_name], zip_filesizes[file_name], mode): file_name
+            for file_name in zip_checksums
+        }
+        for future in concurrent.futures.as_completed(futures):
+            for reason in future.result():
+                logger.info(f"------{reason}------")
+                failed_checks.add(futures[future])
+
+    elapsed = time.monotonic() - start
+    total_size = sum(zip_filesizes.values())
+    logger.info(f"------Integrity check ({mode}) of {len(zip_checksums)} files, {total_size / 1e6:.1f} MB in {elapsed:.2f}s: {os.path.basename(zip_filepath)}------")
 
     if failed_checks:
-        logger.error("------Integrity check failed for files:", failed_checks, "------")
+        logger.error(f"------Integrity check failed for files: {sorted(failed_checks)}------")
         return False
     logger.info("------Passed all integrity checks------")
     return True
+
+def get_member_path(extracted_dir, member_name):
+    """Returns where a ZIP member is extracted to, or None if its name would escape extracted_dir."""
+    parts = [part for part in member_name.replace('\\', '/').split('/') if part not in ('', '.')]
+    if not parts or '..' in parts or os.path.splitdrive(parts[0])[0]:
+        return None
+    return os.path.join(extracted_dir, *parts)
+
+def extract_member_and_verify(zip_file, info, extracted_dir, chunk_size=EXTRACT_CHUNK_SIZE):
+    """
+    Extracts one ZIP member in chunks of chunk_size, computing its CRC32 and size as it is written.
+    Returns None if it matches the central directory, otherwise the reason it failed.
+    """
+    target_path = get_member_path(extracted_dir, info.filename)
+    if target_path is None:
+        return "unsafe path"
+
+    if info.is_dir():
+        os.makedirs(target_path, exist_ok=True)
+        return None
+
+    os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    crc = 0
+    try:
+        with zip_file.open(info) as source, open(target_path, 'wb') as target:
+            for chunk in iter(lambda: source.read(chunk_size), b""):
+                target.write(chunk)
+                crc = zlib.crc32(chunk, crc)
+            written = target.tell()
+    except zipfile.BadZipFile as e:
+        # zipfile itself raises on a bad CRC once the member has been read
+        return str(e)
+
+    if written != info.file_size:
+        return f"file size mismatch ({written} != {info.file_size})"
+    if crc != info.CRC:
+        return "CRC32 mismatch"
+    return None
+
+def extract_and_verify(zip_filepath, extracted_dir, chunk_size=EXTRACT_CHUNK_SIZE):
+    """
+    Extracts a ZIP archive and verifies it in a single pass.
+    Every member is decompressed once, in bounded chunks, and its CRC32 and
+    size are checked against the central directory while it is written.
+    Returns a dictionary of the members that failed and why.
+    """
+    failed_checks = {}
+
+    with zipfile.ZipFile(zip_filepath, "r") as zip_file:
+        for info in zip_file.infolist():
+            reason = extract_member_and_verify(zip_file, info, extracted_dir, chunk_size)
+            if reason:
+                logger.info(f"------{reason}: {info.filename}------")
+                failed_checks[info.filename] = reason
+
+    if failed_checks:
+        logger.error(f"------Integrity check failed for files: {sorted(failed_checks)}------")
+    else:
+        logger.info("------Passed all integrity checks------")
+    return failed_checks
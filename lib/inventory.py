@@ -0,0 +1,154 @@
+'''
+Persistent index of the products stored in the archive tree.
+
+Checking whether a product is already on disk with glob or os.path.exists
+costs metadata requests to the file system for every product, which adds up
+on Lustre/NFS. Instead, the tree is crawled once with os.scandir (the
+directories of each level in parallel) into an SQLite table keyed by the
+product's short name (see extract_short_name_by_mission), which is updated
+as products are stored and queried in bulk.
+
+A full crawl (build_inventory) also removes products that have disappeared
+from disk since the previous crawl.
+'''
+
+import concurrent.futures
+import os
+import re
+import sqlite3
+import time
+from lib.utils import init_logging, extract_short_name_by_mission
+
+logger = init_logging()
+
+# Products are stored as e.g. S1A_..., S2B_..., S5P_..., under platform
+# directories (S1A, S2B, ...) that have no underscore after the platform
+PRODUCT_NAME_PATTERN = re.compile(r'^S\d\w_')
+EXCLUDED_DIRS = ('metadata',)
+LOOKUP_BATCH_SIZE = 500 # Stay below SQLite's limit on query parameters
+
+def get_short_name(entry_name):
+    '''
+    Returns the short name of a stored product from its file or directory
+    name, e.g. "S2B_MSIL1C_..._T32VNM_20240101T120000.SAFE".
+    '''
+    product_name = re.sub(r'(\.\w+){1,2}$', '', entry_name)
+    return extract_short_name_by_mission(product_name)
+
+def create_inventory_table(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS inventory (
+            short_name TEXT PRIMARY KEY,
+            path TEXT,
+            size INTEGER,
+            mtime REAL,
+            crawled_at REAL
+        )
+    """)
+
+def scan_directory(path):
+    '''
+    Returns (subdirectories to crawl, (short name, path, size, mtime) of the products) in path.
+    Product directories (.SAFE, .SEN3) are not descended into.
+    '''
+    subdirectories = []
+    products = []
+    try:
+        entries = list(os.scandir(path))
+    except (FileNotFoundError, NotADirectoryError, PermissionError) as e:
+        logger.warning(f"------Could not scan {path}: {e}------")
+        return subdirectories, products
+
+    for entry in entries:
+        if entry.name.startswith('.') or entry.name in EXCLUDED_DIRS:
+            continue
+        if PRODUCT_NAME_PATTERN.match(entry.name):
+            stat = entry.stat(follow_symlinks=False)
+            products.append((get_short_name(entry.name), entry.path, stat.st_size, stat.st_mtime))
+        elif entry.is_dir(follow_symlinks=False):
+            subdirectories.append(entry.path)
+    return subdirectories, products
+
+def build_inventory(db_path, root, workers=None):
+    '''
+    Crawl root and replace the contents of the inventory with what is on disk.
+    Returns the number of products found.
+    '''
+    start = time.time()
+    found = 0
+    conn = sqlite3.connect(db_path)
+    try:
+        create_inventory_table(conn)
+        frontier = [root]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            while frontier:
+                next_frontier = []
+                for subdirectories, products in executor.map(scan_directory, frontier):
+                    next_frontier.extend(subdirectories)
+                    found += len(products)
+                    with conn:
+                        conn.executemany(
+                            "INSERT OR REPLACE INTO inventory (short_name, path, size, mtime, crawled_at) VALUES (?, ?, ?, ?, ?)",
+                            [product + (start,) for product in products]
+                        )
+                frontier = next_frontier
+
+        # Products not seen by this crawl are no longer on disk
+        with conn:
+            removed = conn.execute("DELETE FROM inventory WHERE crawled_at < ?", (start,)).rowcount
+    finally:
+        conn.close()
+
+    logger.info(f"------Inventory of {root}: {found} products, {removed} removed, crawled in {time.time() - start:.1f}s------")
+    return found
+
+def inventory_exists(db_path):
+    '''
+    Returns whether the inventory has been built at db_path.
+    '''
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'inventory'").fetchone() is not None
+    finally:
+        conn.close()
+
+def record_products(db_path, paths):
+    '''
+    Add products that were just stored (paths of their .SAFE/.SEN3 directory or file) to the inventory.
+    '''
+    now = time.time()
+    rows = []
+    for path in paths:
+        stat = os.stat(path)
+        rows.append((get_short_name(os.path.basename(path)), path, stat.st_size, stat.st_mtime, now))
+
+    conn = sqlite3.connect(db_path, timeout=30)
+    try:
+        create_inventory_table(conn)
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO inventory (short_name, path, size, mtime, crawled_at) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+    finally:
+        conn.close()
+
+def get_stored_short_names(db_path, short_names):
+    '''
+    Returns the subset of short_names that are in the inventory.
+    '''
+    short_names = list(set(short_names))
+    stored = set()
+    conn = sqlite3.connect(db_path)
+    try:
+        for i in range(0, len(short_names), LOOKUP_BATCH_SIZE):
+            batch = short_names[i:i + LOOKUP_BATCH_SIZE]
+            placeholders = ', '.join('?' * len(batch))
+            stored.update(
+                row[0] for row in conn.execute(f"SELECT short_name FROM inventory WHERE short_name IN ({placeholders})", batch)
+            )
+    finally:
+        conn.close()
+    return stored
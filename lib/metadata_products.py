@@ -1,7 +1,10 @@
 import requests
 import json
 import os
+import concurrent.futures
+import threading
 from lib.utils import date_from_string, load_values_from_config, init_logging
+from lib.inventory import get_stored_short_names, get_short_name
 import sys
 
 (
@@ -16,9 +19,32 @@ import sys
 
 logger = init_logging()
 
+MAX_RECORDS = 1000 # Number of products to query in one go
+PAGE_ATTEMPTS = 5
+PAGE_RETRY_WAIT = 10 # Seconds, multiplied by the attempt number
+
+class NDJSONRecords:
+    '''
+    The records of a newline-delimited JSON file, read one line at a time
+    each time they are iterated over, so they are never all in memory.
+    '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+
+    def __iter__(self):
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
 class Metadata_products:
 
-    def __init__(self, satellite=None, productType=None, start_date=None, end_date=None, json_filepath=None):
+    def __init__(self, satellite=None, productType=None, start_date=None, end_date=None, json_filepath=None, ndjson=False):
+        '''
+        With ndjson the harvest is written as newline-delimited JSON (.ndjson),
+        one product per line, as the pages arrive, and read back lazily.
+        '''
         if satellite:
             self.satellite = satellite
         if productType:
@@ -31,47 +57,104 @@ class Metadata_products:
         if json_filepath:
             self.filepath = json_filepath
         elif self.satellite and self.productType and self.start_date and self.end_date:
-            self.filename = f'CDSE_{satellite}_{productType}_{start_date}-{end_date}_all_products.json'
+            extension = 'ndjson' if ndjson else 'json'
+            self.filename = f'CDSE_{satellite}_{productType}_{start_date}-{end_date}_all_products.{extension}'
             self.filepath = os.path.join(output_dir, self.filename)
         else:
             logger.info(f"------Class requires you to provide either a JSON file to download products or all 4 arguements (satellite, productType, start_date, end_date) ")
             sys.exit(1)
 
-    def harvest_all_products_to_json(self):
-        logger.info(f"------Creating JSON file of {self.satellite} {self.productType} products that are present on CDSE between {self.start_date} and {self.end_date} -------")
+    def get_search_url(self, page):
         base_url = "https://catalogue.dataspace.copernicus.eu/resto/api/collections/"
-        maxRecords = 1000 # Number of products to query in one go
-
-        # Initialize an empty list to store the records
-        self.all_records = []
-        page = 1
-
-        while True:
-
-            # Create the URL with the current offset and limit
-            if self.productType == 'all':
-                url = f"{base_url}{self.satellite}/search.json?startDate={self.start_date}T00:00:00Z&completionDate={self.end_date}T00:00:00Z&sortParam=startDate&geometry={polygon}&maxRecords={maxRecords}&page={page}"
-            else:
-                url = f"{base_url}{self.satellite}/search.json?productType={self.productType}&startDate={self.start_date}T00:00:00Z&completionDate={self.end_date}T00:00:00Z&sortParam=startDate&geometry={polygon}&maxRecords={maxRecords}&page={page}"
-            # Make the request and get the JSON response
-            response = requests.get(url).json()
+        if self.productType == 'all':
+            return f"{base_url}{self.satellite}/search.json?startDate={self.start_date}T00:00:00Z&completionDate={self.end_date}T00:00:00Z&sortParam=startDate&geometry={polygon}&maxRecords={MAX_RECORDS}&page={page}"
+        return f"{base_url}{self.satellite}/search.json?productType={self.productType}&startDate={self.start_date}T00:00:00Z&completionDate={self.end_date}T00:00:00Z&sortParam=startDate&geometry={polygon}&maxRecords={MAX_RECORDS}&page={page}"
 
-            # Append the records from the current response to the list
-            self.all_records.extend(response.get("features", []))
+    def fetch_page(self, page, stop=None):
+        '''
+        Returns the records of one page of results, retrying failed requests
+        (e.g. HTTP 429 or 5xx) until stop (a threading.Event), if given, is
+        set. Raises if the page cannot be fetched, so a harvest is never
+        mistaken for complete.
+        '''
+        stop = stop or threading.Event()
+        for attempt in range(1, PAGE_ATTEMPTS + 1):
+            try:
+                response = requests.get(self.get_search_url(page))
+                response.raise_for_status()
+                return response.json()["features"]
+            except (requests.RequestException, ValueError, KeyError) as e:
+                if attempt == PAGE_ATTEMPTS or stop.is_set():
+                    raise IOError(f"Could not fetch page {page} of {self.satellite} {self.productType} products: {e}") from e
+                logger.error(f"------Attempt {attempt} to fetch page {page} failed: {e}, retrying------")
+                if stop.wait(PAGE_RETRY_WAIT * attempt):
+                    raise IOError(f"Stopped fetching page {page} of {self.satellite} {self.productType} products") from e
+
+    def iterate_pages(self, max_concurrent_pages=1):
+        '''
+        Yields the records of each page in order, fetching up to
+        max_concurrent_pages pages at a time. The last page is the first one
+        with fewer than MAX_RECORDS records, the pages after it that were
+        already requested come back empty and are dropped.
+        '''
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrent_pages)
+        stop = threading.Event()
+        try:
+            futures = {page: executor.submit(self.fetch_page, page, stop) for page in range(1, max_concurrent_pages + 1)}
+            next_page = max_concurrent_pages + 1
+            page = 1
+            while True:
+                records = futures.pop(page).result()
+                yield records
+                if len(records) < MAX_RECORDS:
+                    break  # No more records to fetch
+                futures[next_page] = executor.submit(self.fetch_page, next_page, stop)
+                next_page += 1
+                page += 1
+        finally:
+            # Don't wait for the pages requested beyond the last one (or
+            # after an error) to finish retrying
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def harvest_all_products_to_json(self, max_concurrent_pages=1):
+        logger.info(f"------Creating JSON file of {self.satellite} {self.productType} products that are present on CDSE between {self.start_date} and {self.end_date} -------")
 
-            # Check if there are more records to fetch
-            if len(response.get("features", [])) < maxRecords:
-                break  # No more records to fetch
+        if self.filepath.endswith('.ndjson'):
+            # Write each page as it arrives, then move the complete file into place
+            tmp_filepath = self.filepath + '.part'
+            try:
+                with open(tmp_filepath, 'w', encoding='utf-8') as f:
+                    for records in self.iterate_pages(max_concurrent_pages):
+                        f.writelines(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+            except BaseException:
+                # Never leave a truncated harvest behind
+                if os.path.exists(tmp_filepath):
+                    os.remove(tmp_filepath)
+                raise
+            os.replace(tmp_filepath, self.filepath)
+            self.all_records = NDJSONRecords(self.filepath)
+            logger.info(f"------File created: {self.filepath}-------")
+            return
 
-            # Increment page for the next request
-            page = page + 1
+        # Initialize an empty list to store the records
+        self.all_records = []
+        for records in self.iterate_pages(max_concurrent_pages):
+            self.all_records.extend(records)
 
         with open(self.filepath, 'w', encoding='utf-8') as f:
             json.dump(self.all_records, f, ensure_ascii=False, indent=4)
             logger.info(f"------File created: {self.filepath}-------")
 
     def load_json(self):
+        '''
+        Load the records of a harvest. Those of an .ndjson file are read
+        lazily, each time all_records is iterated over.
+        '''
         logger.info(f"------Loading JSON file of {self.filepath}-------")
+        if self.filepath.endswith('.ndjson'):
+            self.all_records = NDJSONRecords(self.filepath)
+            return
         with open(self.filepath, 'r', encoding='utf-8') as f:
             self.all_records = json.load(f)
 
@@ -137,15 +220,26 @@ class Metadata_products:
         self.metadata_storage_paths = paths
         return paths
 
-    def filter_out_synced_products(self):
+    def filter_out_synced_products(self, inventory_db=None):
+        '''
+        Drop the products already in storage. With inventory_db (see
+        lib/inventory.py) this is one indexed lookup instead of checking the
+        file system for every product.
+        '''
         filtered_products = {}
         filtered_storage_paths = {}
+        if inventory_db:
+            stored = get_stored_short_names(inventory_db, [get_short_name(title) for title in self.product_ids_and_titles.values()])
         for product_id, storage_path in self.storage_paths.items():
-            file_path_SEN3 = os.path.join(storage_path, self.product_ids_and_titles[product_id] + ".SEN3")
-            file_path_SAFE = os.path.join(storage_path, self.product_ids_and_titles[product_id] + ".SAFE")
+            if inventory_db:
+                synced = get_short_name(self.product_ids_and_titles[product_id]) in stored
+            else:
+                file_path_SEN3 = os.path.join(storage_path, self.product_ids_and_titles[product_id] + ".SEN3")
+                file_path_SAFE = os.path.join(storage_path, self.product_ids_and_titles[product_id] + ".SAFE")
+                synced = os.path.exists(file_path_SEN3) or os.path.exists(file_path_SAFE)
 
             # Check if the file path does not exist
-            if not (os.path.exists(file_path_SEN3) or os.path.exists(file_path_SAFE)):
+            if not synced:
                 filtered_products[product_id] = self.product_ids_and_titles[product_id]
                 filtered_storage_paths[product_id] = storage_path
             else:
@@ -1,98 +1,249 @@
 import concurrent.futures
 import functools
 import sys
-import requests
 import os
 import time
-from lib.utils import init_logging
+from lib.utils import init_logging, get_cutoff_time
 from lib.integrity_check import check_extracted_integrity
+from lib.token_manager import get_token_manager
+from lib.http_session import get_download_session
+from lib.stream_download import CHUNK_SIZE, SEGMENT_SIZE, download_resumable, download_segmented, probe_product, is_partial_download
 import pandas as pd
 import re
 import time
 import threading
 import glob
+from datetime import datetime, timezone
 
 logger = init_logging()
 
-# TODO: Run on bigmem
-# TODO: 6 parallel downloads 128 Gb memory limit
-
-def get_access_token(username, password):
-
-    # Define the URL and payload data
-    url = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
-    payload = {
-        'grant_type': 'password',
-        'username': username,
-        'password': password,
-        'client_id': 'cdse-public'
-    }
-
-    # Define the headers
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-
-    # Make the POST request
-    response = requests.post(url, data=payload, headers=headers)
-    response.raise_for_status()
-
-    # Check if the request was successful (status code 200)
-    if response.status_code == 200:
-        # Print the response content (which should contain the access token)
-        return response.json()['access_token']
-    else:
-        # Raise an exception with the error message if the request fails
-        raise Exception(f"Error: {response.status_code} - {response.text}")
+THROTTLING_STATUS_CODES = (429, 503)
+
+_concurrency_controller = None
+
+class ConcurrencyController:
+    '''
+    Tunes how many products are downloaded at once, between floor and ceiling.
+
+    Every interval seconds the aggregate throughput and error rate of the
+    last interval are compared with the interval before:
+        * any 429/503 (throttling) halves the concurrency,
+        * a rising error rate removes one worker,
+        * rising throughput while all workers are busy adds one worker,
+        * otherwise the concurrency is kept.
+    Workers call acquire()/release() (or use the controller as a context
+    manager) around each download, and record the bytes and outcomes they see.
+    '''
+
+    def __init__(self, floor, ceiling, initial=None, interval=30):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.limit = min(max(initial or floor, floor), ceiling)
+        self.interval = interval
+        self.active = 0
+        self._condition = threading.Condition()
+        self._last_rate = None
+        self._last_error_rate = 0.0
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.monotonic()
+        self._bytes = 0
+        self._successes = 0
+        self._errors = 0
+        self._throttled = 0
+        self._saturated = self.active >= self.limit
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def acquire(self):
+        with self._condition:
+            while self.active >= self.limit:
+                self._condition.wait(timeout=self.interval)
+                self._maybe_adjust()
+            self.active += 1
+            if self.active >= self.limit:
+                self._saturated = True
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+    def record_bytes(self, nbytes):
+        with self._condition:
+            self._bytes += nbytes
+            self._maybe_adjust()
+
+    def record_success(self):
+        with self._condition:
+            self._successes += 1
+            self._maybe_adjust()
+
+    def record_error(self, status_code=None):
+        with self._condition:
+            self._errors += 1
+            if status_code in THROTTLING_STATUS_CODES:
+                self._throttled += 1
+            self._maybe_adjust()
+
+    def _maybe_adjust(self):
+        elapsed = time.monotonic() - self._window_start
+        if elapsed < self.interval:
+            return
 
-def download_product(product_id, product_title, access_token, tmp_storage_area):
+        rate = self._bytes / elapsed
+        attempts = self._successes + self._errors
+        error_rate = self._errors / attempts if attempts else 0.0
+        old_limit = self.limit
+
+        if self._throttled:
+            self.limit = max(self.floor, self.limit // 2)
+            reason = f"{self._throttled} throttling responses"
+        elif self._errors and error_rate > self._last_error_rate:
+            self.limit = max(self.floor, self.limit - 1)
+            reason = f"error rate rose from {self._last_error_rate:.0%}"
+        elif self._saturated and (self._last_rate is None or rate > self._last_rate * 1.05):
+            self.limit = min(self.ceiling, self.limit + 1)
+            reason = "throughput rising with all workers busy"
+        else:
+            reason = "no change"
+
+        logger.info(f"------Concurrency {old_limit} -> {self.limit} ({reason}): {rate / 1e6:.1f} MB/s, error rate {error_rate:.0%}------")
+
+        self._last_rate = rate
+        self._last_error_rate = error_rate
+        self._reset_window()
+        self._condition.notify_all()
+
+def get_max_connections(config, workers):
+    '''
+    Returns the number of connections the download workers may open in
+    total (max_connections in the config). By default every worker gets
+    one connection, plus connections_per_product - 1 extra ones for the
+    segments of large products if segmented downloads are enabled, so
+    segments are not starved of connections by the whole-product workers.
+    '''
+    if config.get('max_connections'):
+        return config['max_connections']
+    if config.get('segmented_download_min_size'):
+        return workers * config.get('connections_per_product', 4)
+    return workers
+
+def get_concurrency_controller(config):
     '''
-    Download product from Copernicus Data Space Ecosystem
+    Returns the controller shared by every batch downloaded by this process,
+    or None if adaptive_concurrency is not enabled in the config.
     '''
+    global _concurrency_controller
+    if not config.get('adaptive_concurrency'):
+        return None
+    if _concurrency_controller is None:
+        _concurrency_controller = ConcurrencyController(
+            floor=config.get('min_parallel_downloads', 1),
+            ceiling=config['max_parallel_downloads'],
+            interval=config.get('concurrency_interval', 30)
+        )
+    return _concurrency_controller
+
+def download_product(product_id, product_title, session, tmp_storage_area, config=None, connection_slots=None, progress=None, checksum=None):
+    '''
+    Download product from Copernicus Data Space Ecosystem.
+    The product is streamed to disk in chunks and an unfinished download left
+    in tmp_storage_area is resumed. session is the shared download session
+    (see get_download_session), which keeps connections alive across products
+    and authenticates every request with the shared token manager.
+
+    If config sets segmented_download_min_size, products at least that large
+    are fetched as byte ranges over several connections (see download_segmented).
+    progress, if given, is called with the size of every chunk written.
+    checksum, if given, is the (algorithm, value) published by CDSE, which the
+    download is verified against before it leaves the .part file.
+    '''
+    config = config or {}
+    chunk_size = config.get('download_chunk_size', CHUNK_SIZE)
+    segmented_min_size = config.get('segmented_download_min_size')
+
     logger.info(f"------Downloading product: {product_title}-------")
-    #session = requests.Session()
-    with requests.Session() as session:
-        session.headers.update({'Authorization': f'Bearer {access_token}'})
-        url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
-        #url = f"https://download.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
-        print(product_title, url)
-        response = session.get(url, allow_redirects=False)
-
-    while response.status_code in (301, 302, 303, 307):
-        #print(product_title, response.status_code)
-        url = response.headers['Location']
-        response = session.get(url, allow_redirects=False)
-
-    file = session.get(url, verify=False, allow_redirects=True)
+    url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
+    #url = f"https://download.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
+    print(product_title, url)
     output_filepath = os.path.join(tmp_storage_area, product_title)
 
     if product_title.startswith('S5'):
-        with open(f"{output_filepath}.nc", 'wb') as p:
-            p.write(file.content)
+        output_filepath = f"{output_filepath}.nc"
     else:
-        with open(f"{output_filepath}.zip", 'wb') as p:
-            p.write(file.content)
+        output_filepath = f"{output_filepath}.zip"
+
+    if segmented_min_size:
+        resolved_url, total_length, validator = probe_product(session, url)
+        if total_length is not None and total_length >= segmented_min_size:
+            return download_segmented(
+                session, url, output_filepath, total_length, validator,
+                segment_size=config.get('segment_size', SEGMENT_SIZE),
+                connections_per_product=config.get('connections_per_product', 4),
+                connection_slots=connection_slots,
+                chunk_size=chunk_size,
+                resolved_url=resolved_url,
+                progress=progress,
+                checksum=checksum
+            )
+
+    return download_resumable(session, url, output_filepath, chunk_size, progress, checksum)
+
+def download_product_with_retries(product_id, title, output_directory, max_retries, session, config=None, connection_slots=None, controller=None, checksums=None):
+    # A corrupt download (checksum mismatch) is discarded and retried like any other failure
+    checksum = checksums.get(product_id) if checksums else None
+    progress = controller.record_bytes if controller is not None else None
+    return run_with_retries(
+        lambda: download_product_attempt(product_id, title, output_directory, session, config, connection_slots, progress, checksum),
+        product_id, title, max_retries, controller
+    )
 
-def download_product_with_retries(product_id, title, output_directory, max_retries, token_lock, access_token):
+def run_with_retries(attempt, product_id, title, max_retries, controller=None):
+    '''
+    Call attempt() until it succeeds, at most max_retries times, backing off
+    as asked by the server when it throttles. With a controller (see
+    ConcurrencyController) each call holds one of its slots and the outcome
+    is recorded, so errors reduce the number of parallel downloads.
+    '''
     retries = 0
     while retries < max_retries:
         try:
-            with token_lock:
-                current_token = access_token[0]
-            return download_product(product_id, title, current_token, output_directory)
+            if controller is None:
+                return attempt()
+            with controller:
+                result = attempt()
+            controller.record_success()
+            return result
         except Exception as e:
-            print(str(e))
-            if 'token expired' in str(e).lower():
-                with token_lock:
-                    access_token[0] = get_access_token('dhr@met.no', '6tj&Rh=n9~GA)4>')
-                print(f"Token refreshed for product {product_id} ({title})")
-            else:
-                retries += 1
-                print(f"Retry {retries}/{max_retries} for product {product_id} ({title}) due to error: {e}")
-                if retries < max_retries:
+            retries += 1
+            response = getattr(e, 'response', None)
+            status_code = getattr(response, 'status_code', None)
+            if controller is not None:
+                controller.record_error(status_code)
+            print(f"Retry {retries}/{max_retries} for product {product_id} ({title}) due to error: {e}")
+            if retries < max_retries:
+                if status_code in THROTTLING_STATUS_CODES:
+                    # Back off as asked by the server, or exponentially
+                    retry_after = response.headers.get('Retry-After', '')
+                    time.sleep(int(retry_after) if retry_after.isdigit() else 2 ** retries)
+                else:
                     time.sleep(1)  # Optional: wait a bit before retrying
     raise Exception(f"Failed to download product {product_id} ({title}) after {max_retries} retries.")
 
+def download_product_attempt(product_id, title, output_directory, session, config=None, connection_slots=None, progress=None, checksum=None):
+    if connection_slots is None:
+        return download_product(product_id, title, session, output_directory, config, progress=progress, checksum=checksum)
+    # Hold one slot of the global connection budget for the whole product
+    with connection_slots:
+        return download_product(product_id, title, session, output_directory, config, connection_slots, progress, checksum)
+
 def check_download_status(list_of_products, tmp_storage_area):
 
     successes = []
@@ -100,7 +251,8 @@ def check_download_status(list_of_products, tmp_storage_area):
 
     for id, product_name in list_of_products:
         pattern = os.path.join(tmp_storage_area, f"{product_name}.*")
-        matching_files = glob.glob(pattern)
+        # Unfinished downloads are left as .part files and are not successes
+        matching_files = [f for f in glob.glob(pattern) if not is_partial_download(f)]
 
         if matching_files:
             successes.append((id, product_name))
@@ -110,7 +262,16 @@ def check_download_status(list_of_products, tmp_storage_area):
     return successes, failures
 
 
-def download_list_of_products(list_of_products, config):
+def download_list_of_products(list_of_products, config, checksums=None):
+    '''
+    Download a batch of (id, name) products to tmp_storage_area.
+    checksums optionally maps product ids to the (algorithm, value) published by CDSE.
+    '''
+
+    if config.get('download_engine', 'threads') == 'asyncio':
+        # Imported here since only the asyncio engine needs aiohttp
+        from lib.async_download import download_list_of_products as download_list_of_products_asyncio
+        return download_list_of_products_asyncio(list_of_products, config, checksums)
 
     max_parallel_downloads = config['max_parallel_downloads']
     max_retries = config['max_retries_per_iteration']
@@ -118,18 +279,27 @@ def download_list_of_products(list_of_products, config):
     output_dir = config['output_dir']
     username = config['username']
     password = config['password']
+    # Whole-product workers and extra segment connections share this budget
+    max_connections = get_max_connections(config, max_parallel_downloads)
 
+    # Shared by all workers and reused across calls, so a token is only
+    # fetched when the current one is about to expire.
+    token_manager = get_token_manager(username, password)
     try:
-        access_token = get_access_token(username, password)
-        # Do something with the access token here
+        token_manager.get_token()
     except Exception as e:
         sys.exit(e)
 
+    session = get_download_session(token_manager, max_connections)
+
     # Process downloads
-    token_lock = threading.Lock()
+    connection_slots = threading.BoundedSemaphore(max_connections)
+    # With adaptive_concurrency, max_parallel_downloads is the ceiling and
+    # the controller decides how many of the workers download at once.
+    controller = get_concurrency_controller(config)
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=max_parallel_downloads) as executor:
-        partial_download_product = functools.partial(download_product_with_retries, output_directory=tmp_storage_area, max_retries=max_retries, token_lock=token_lock, access_token=[access_token])
+        partial_download_product = functools.partial(download_product_with_retries, output_directory=tmp_storage_area, max_retries=max_retries, session=session, config=config, connection_slots=connection_slots, controller=controller, checksums=checksums)
         # Submit all the download tasks to the executor
         future_to_product = {executor.submit(partial_download_product, pid, title): (pid, title) for pid, title in list_of_products}
 
@@ -142,12 +312,98 @@ def download_list_of_products(list_of_products, config):
             except Exception as exc:
                 print(f"Product {product_id} ({title}) generated an exception: {exc}")
 
+    logger.info(f"------Token requests so far: {token_manager.token_fetches}------")
+
     # Failures needs to scan downloaded products
     successes, failures = check_download_status(list_of_products, tmp_storage_area)
 
-    # Move products to their storage location
-    #TODO: Write this function
-    #* Where should the products be stored if also syncing from GSS?
-    #move_products(successes, tmp_storage_area, output_dir)
+    # Products are moved to their storage location by the pipeline
+    # (see lib/pipeline.py, "pipeline: true" in the config)
+
+    return successes, failures
+
+def run_download_lane(lane, config, download, fetch_products, report_results, cutoff):
+    '''
+    Keep lane['parallel_downloads'] workers busy with products fetched from
+    the queue until the cutoff time, reporting each product as it finishes
+    instead of waiting for a whole batch.
+    '''
+    tmp_storage_area = config['tmp_storage_area']
+    batch_size = max(config.get('number_downloads_per_iteration', 0), lane['parallel_downloads'])
+    poll_interval = config.get('queue_poll_interval', 600)
+    in_flight = {}
+    pending = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=lane['parallel_downloads']) as executor:
+        while True:
+            past_cutoff = datetime.now(timezone.utc) > cutoff
+
+            while not past_cutoff and len(in_flight) < lane['parallel_downloads']:
+                if not pending:
+                    # Largest products first within the lane (see claim_products)
+                    pending = fetch_products(lane, batch_size)
+                    if not pending:
+                        break
+                product_id, title = pending.pop(0)
+                in_flight[executor.submit(download, product_id, title)] = (product_id, title)
+
+            if not in_flight:
+                if past_cutoff:
+                    return
+                logger.info(f"------No products in the {lane['name']} lane queue. Sleeping...------")
+                time.sleep(max(min(poll_interval, (cutoff - datetime.now(timezone.utc)).total_seconds()), 1))
+                continue
+
+            done, _ = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                product_id, title = in_flight.pop(future)
+                finished.append((product_id, title))
+                try:
+                    data = future.result()
+                    print(f"Downloaded product {product_id} ({title}): {data}")
+                except Exception as exc:
+                    print(f"Product {product_id} ({title}) generated an exception: {exc}")
+
+            # Products that failed stay in the queue, which holds them back
+            # for failed_retry_delay seconds (see report_results)
+            report_results(*check_download_status(finished, tmp_storage_area))
+
+def download_queue_in_lanes(lanes, config, fetch_products, report_results, checksums=None):
+    '''
+    Download products from a queue in separate size lanes until the cutoff.
+
+    Each lane is a dict with a name, min_size/max_size bounds and its own
+    number of parallel_downloads. fetch_products(lane, limit) returns the
+    next (id, name) tuples for a lane and report_results(successes, failures)
+    is called as products finish.
+    All lanes share the token, session and connection budget.
+    checksums optionally maps product ids to the (algorithm, value) published
+    by CDSE, fetch_products may add to it as it returns products.
+    '''
+    tmp_storage_area = config['tmp_storage_area']
+    max_retries = config['max_retries_per_iteration']
+    max_connections = get_max_connections(config, sum(lane['parallel_downloads'] for lane in lanes))
+    cutoff = get_cutoff_time(config.get('download_cutoff', '23:30'))
+
+    token_manager = get_token_manager(config['username'], config['password'])
+    try:
+        token_manager.get_token()
+    except Exception as e:
+        sys.exit(e)
+
+    session = get_download_session(token_manager, max_connections)
+    connection_slots = threading.BoundedSemaphore(max_connections)
+    controller = get_concurrency_controller(config)
+    download = functools.partial(download_product_with_retries, output_directory=tmp_storage_area, max_retries=max_retries, session=session, config=config, connection_slots=connection_slots, controller=controller, checksums=checksums)
+
+    threads = [
+        threading.Thread(target=run_download_lane, args=(lane, config, download, fetch_products, report_results, cutoff), name=f"{lane['name']}-lane")
+        for lane in lanes
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
 
-    return successes, failures
\ No newline at end of file
+    logger.info(f"------Token requests so far: {token_manager.token_fetches}------")
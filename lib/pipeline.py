@@ -0,0 +1,367 @@
+'''
+Staged pipeline that downloads, verifies and stores products from the queue.
+
+    queue -> download -> verify -> extract/store
+
+Each stage has its own pool of workers and takes its work from a bounded
+queue. A stage whose downstream queue is full blocks until there is room,
+so a slow stage holds back the ones before it instead of filling the disk,
+while downloading (network) and extracting (CPU) run at the same time.
+The depth of every queue and the number of busy workers per stage are
+logged at a regular interval (see Pipeline.queue_depths).
+
+Products are only reported as done, and so removed from the queue, once
+they are stored in the archive tree. At the cutoff time, the products still
+waiting to be downloaded are given back to the queue. Downloads in progress
+are finished, and every product downloaded is verified and stored before
+the job ends, so no finished download is thrown away.
+
+If the config sets include_patterns, only the zip members matching them are
+fetched with range requests and stored by the download stage itself (see
+lib/remote_zip.py), and the verify and extract/store stages pass them through.
+'''
+
+import concurrent.futures
+import os
+import queue
+import shutil
+import sys
+import threading
+import zipfile
+from datetime import datetime, timezone
+from lib.utils import init_logging, get_cutoff_time, predict_base_path
+from lib.token_manager import get_token_manager
+from lib.http_session import get_download_session
+from lib.extraction import extract_product
+from lib.remote_zip import download_members
+from lib.inventory import record_products
+from lib.stream_download import CHUNK_SIZE
+from lib.parallel_download import download_product_with_retries, run_with_retries, get_concurrency_controller, get_max_connections
+
+logger = init_logging()
+
+STOP_POLL_INTERVAL = 1 # Seconds between checks whether a stage has been stopped
+
+class Stage:
+    '''
+    Worker threads taking items from a bounded input queue.
+
+    function(item) returns the item for the next stage (or for on_success if
+    this is the last stage) and raises to drop the item, which is then passed
+    to on_failure. Items still queued when the stage is stopped are passed
+    to on_drop, while a closed stage finishes every item queued.
+    '''
+
+    def __init__(self, name, function, workers, queue_size, on_failure, on_drop, next_stage=None, on_success=None):
+        self.name = name
+        self.function = function
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.on_failure = on_failure
+        self.on_drop = on_drop
+        self.next_stage = next_stage
+        self.on_success = on_success
+        self.busy = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._closed = threading.Event()
+        self.threads = [
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True)
+            for i in range(workers)
+        ]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item, deadline=None):
+        '''
+        Queue item, blocking while the queue is full. If the stage is stopped,
+        or deadline (UTC datetime) passes, first, the item is dropped instead.
+        Returns whether the item was queued.
+        '''
+        while not self._stop.is_set() and (deadline is None or datetime.now(timezone.utc) < deadline):
+            try:
+                self.queue.put(item, timeout=STOP_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                continue
+        self.on_drop(item)
+        return False
+
+    def _work(self):
+        while not self._stop.is_set():
+            try:
+                item = self.queue.get(timeout=STOP_POLL_INTERVAL)
+            except queue.Empty:
+                if self._closed.is_set():
+                    return
+                continue
+            with self._lock:
+                self.busy += 1
+            try:
+                result = self.function(item)
+            except Exception as e:
+                logger.error(f"------{self.name} failed for {item[1]}: {e}------")
+                self.on_failure(item)
+            else:
+                if self.next_stage is not None:
+                    self.next_stage.put(result)
+                elif self.on_success is not None:
+                    self.on_success(result)
+            finally:
+                with self._lock:
+                    self.busy -= 1
+
+    def drop_queued(self):
+        while True:
+            try:
+                self.on_drop(self.queue.get_nowait())
+            except queue.Empty:
+                return
+
+    def stop(self):
+        '''
+        Stop taking items from the queue and drop those still queued. Items
+        being processed are finished.
+        '''
+        self._stop.set()
+        self.drop_queued()
+
+    def close(self):
+        '''
+        Let the workers exit once every item queued has been processed. Only
+        call once nothing is put on the queue anymore.
+        '''
+        self._closed.set()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+        # Items put while the stage was stopping
+        self.drop_queued()
+
+def get_download_filepath(tmp_storage_area, product_title):
+    extension = 'nc' if product_title.startswith('S5') else 'zip'
+    return os.path.join(tmp_storage_area, f"{product_title}.{extension}")
+
+def verify_download(item):
+    '''
+    Check that a downloaded product is complete before it is extracted.
+    The checksum published by CDSE was already checked while downloading,
+    this catches archives whose central directory is unreadable.
+    '''
+    product_id, title, filepath = item
+    if filepath is None:
+        # Selected members were verified as they were stored
+        return item
+    if not os.path.exists(filepath):
+        raise IOError(f"{filepath} not found")
+    if filepath.endswith('.zip'):
+        with zipfile.ZipFile(filepath, "r") as zip_file:
+            if not zip_file.infolist():
+                raise IOError(f"{filepath} is empty")
+    return item
+
+class Pipeline:
+    '''
+    Download products from the queue through the download, verify and
+    extract/store stages until the cutoff time.
+
+    fetch_products(limit) returns the next (id, name) tuples from the queue,
+    leaving out the products in the pipeline and those that failed recently,
+    and report_results(successes, failures) is called as products are stored
+    or fail in a stage. release_products(products), if
+    given, is called with the products dropped at the cutoff, to give them
+    back to the queue. checksums optionally maps product ids to the
+    (algorithm, value) published by CDSE.
+    '''
+
+    def __init__(self, config, fetch_products, report_results, checksums=None, release_products=None):
+        self.config = config
+        self.fetch_products = fetch_products
+        self.report_results = report_results
+        self.release_products = release_products
+        self.checksums = checksums
+        self.in_flight = set()
+        self._lock = threading.Lock()
+        # Set whenever a product leaves the pipeline
+        self.progress = threading.Event()
+
+        download_workers = config['max_parallel_downloads']
+        verify_workers = config.get('verify_workers', 2)
+        extraction_workers = config.get('extraction_workers', os.cpu_count() or 1)
+        queue_size = config.get('pipeline_queue_size', download_workers)
+
+        self.extraction_pool = concurrent.futures.ProcessPoolExecutor(max_workers=extraction_workers)
+        self.store_stage = Stage('store', self.store_product, extraction_workers, queue_size, self.failed, self.dropped, on_success=self.stored)
+        self.verify_stage = Stage('verify', verify_download, verify_workers, queue_size, self.failed, self.dropped, next_stage=self.store_stage)
+        self.download_stage = Stage('download', self.download_product, download_workers, queue_size, self.failed, self.dropped, next_stage=self.verify_stage)
+        self.stages = [self.download_stage, self.verify_stage, self.store_stage]
+
+    def download_product(self, item):
+        product_id, title = item
+        include_patterns = self.config.get('include_patterns')
+        if include_patterns and not title.startswith('S5'):
+            return self.download_selected_members(product_id, title, include_patterns)
+        download_product_with_retries(
+            product_id, title, self.config['tmp_storage_area'],
+            self.config['max_retries_per_iteration'], self.session, self.config,
+            self.connection_slots, self.controller, self.checksums
+        )
+        return product_id, title, get_download_filepath(self.config['tmp_storage_area'], title)
+
+    def download_selected_members(self, product_id, title, include_patterns):
+        '''
+        Fetch only the members matching include_patterns, retried like a full
+        download (members that fail their CRC32 check included).
+        '''
+        url = f"https://catalogue.dataspace.copernicus.eu/odata/v1/Products({product_id})/$value"
+        storage_path = predict_base_path(title, self.config['output_dir'], self.config['product_types_csv'])
+        os.makedirs(storage_path, exist_ok=True)
+
+        def attempt():
+            with self.connection_slots:
+                failed_checks = download_members(
+                    self.session, url, title, storage_path, include_patterns,
+                    self.config.get('download_chunk_size', CHUNK_SIZE)
+                )
+            if failed_checks:
+                raise IOError(f"{len(failed_checks)} files failed their integrity checks")
+
+        run_with_retries(attempt, product_id, title, self.config['max_retries_per_iteration'], self.controller)
+        return product_id, title, None
+
+    def store_product(self, item):
+        '''
+        Extract a product archive into the archive tree in a worker process,
+        or move it there if it is not an archive (Sentinel-5P netCDF).
+        '''
+        product_id, title, filepath = item
+        if filepath is None:
+            return item
+        storage_path = predict_base_path(title, self.config['output_dir'], self.config['product_types_csv'])
+        os.makedirs(storage_path, exist_ok=True)
+
+        if not filepath.endswith('.zip'):
+            shutil.move(filepath, os.path.join(storage_path, os.path.basename(filepath)))
+            return item
+
+        try:
+            failed_checks = self.extraction_pool.submit(extract_product, filepath, storage_path).result()
+        finally:
+            os.remove(filepath)
+        if failed_checks:
+            raise IOError(f"{len(failed_checks)} files failed their integrity checks")
+        return item
+
+    def stored(self, item):
+        product_id, title, _ = item
+        if self.config.get('inventory_db'):
+            storage_path = predict_base_path(title, self.config['output_dir'], self.config['product_types_csv'])
+            record_products(self.config['inventory_db'], [
+                os.path.join(storage_path, name) for name in os.listdir(storage_path) if name.startswith(title)
+            ])
+        self.report((product_id, title), True)
+
+    def failed(self, item):
+        self.report(item[:2], False)
+
+    def dropped(self, item):
+        '''
+        Give a product not downloaded by the cutoff back to the queue, without
+        counting an attempt.
+        '''
+        with self._lock:
+            self.in_flight.discard(item[0])
+            if self.release_products is not None:
+                self.release_products([item[:2]])
+        self.progress.set()
+
+    def report(self, product, success):
+        with self._lock:
+            self.in_flight.discard(product[0])
+            if success:
+                self.report_results([product], [])
+            else:
+                self.report_results([], [product])
+        self.progress.set()
+
+    def queue_depths(self):
+        '''
+        Returns {stage name: (queued items, busy workers)}.
+        '''
+        return {stage.name: (stage.queue.qsize(), stage.busy) for stage in self.stages}
+
+    def log_queue_depths(self, stop, interval):
+        while not stop.wait(interval):
+            depths = ', '.join(
+                f"{name} {queued} queued/{busy} busy"
+                for name, (queued, busy) in self.queue_depths().items()
+            )
+            logger.info(f"------Pipeline: {depths}------")
+
+    def run(self):
+        config = self.config
+        download_workers = config['max_parallel_downloads']
+        batch_size = max(config.get('number_downloads_per_iteration', 0), download_workers)
+        poll_interval = config.get('queue_poll_interval', 600)
+        cutoff = get_cutoff_time(config.get('download_cutoff', '23:30'))
+
+        token_manager = get_token_manager(config['username'], config['password'])
+        try:
+            token_manager.get_token()
+        except Exception as e:
+            sys.exit(e)
+
+        max_connections = get_max_connections(config, download_workers)
+        self.session = get_download_session(token_manager, max_connections)
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+        self.controller = get_concurrency_controller(config)
+
+        stop = threading.Event()
+        monitor = threading.Thread(
+            target=self.log_queue_depths, args=(stop, config.get('pipeline_report_interval', 60)),
+            name='pipeline-monitor', daemon=True
+        )
+        for stage in self.stages:
+            stage.start()
+        monitor.start()
+
+        try:
+            while datetime.now(timezone.utc) < cutoff:
+                self.progress.clear()
+                products = self.fetch_products(batch_size)
+                if not products:
+                    # Wake as soon as a product leaves the pipeline, since it
+                    # may have been given back to the queue, or every poll_interval
+                    with self._lock:
+                        idle = not self.in_flight
+                    if idle:
+                        logger.info('------No products in queue. Sleeping...------')
+                    self.progress.wait(max(min(poll_interval, (cutoff - datetime.now(timezone.utc)).total_seconds()), 1))
+                    continue
+                for product in products:
+                    with self._lock:
+                        self.in_flight.add(product[0])
+                    # Blocks while the pipeline is full, until the cutoff time
+                    self.download_stage.put(product, deadline=cutoff)
+        finally:
+            # Give back the products not yet downloading and finish the
+            # downloads in progress, then let each later stage finish what
+            # it was given before closing the next one
+            self.download_stage.stop()
+            self.download_stage.join()
+            for stage in self.stages[1:]:
+                stage.close()
+                stage.join()
+            stop.set()
+            self.extraction_pool.shutdown()
+
+        logger.info(f"------Token requests so far: {token_manager.token_fetches}------")
+
+def download_queue_in_pipeline(config, fetch_products, report_results, checksums=None, release_products=None):
+    '''
+    Run the download -> verify -> extract/store pipeline until the cutoff time.
+    See Pipeline for the arguments.
+    '''
+    Pipeline(config, fetch_products, report_results, checksums, release_products).run()
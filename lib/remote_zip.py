@@ -0,0 +1,189 @@
+'''
+Selective download of members from a remote product zip.
+
+The zip is read in place on the download server with HTTP range requests:
+the end of the archive gives the central directory, which lists every member
+and where it starts, and only the members matching the include patterns are
+then fetched, verified against their CRC32 and written into the storage
+layout. For consumers that only need manifest.safe, the annotation XML or a
+single band this transfers a small fraction of the product.
+'''
+
+import fnmatch
+import io
+import os
+import shutil
+import zipfile
+from lib.utils import init_logging
+from lib.stream_download import CHUNK_SIZE, open_product_stream, parse_content_range, probe_product
+from lib.integrity_check import extract_member_and_verify
+from lib.extraction import get_staging_dir
+
+logger = init_logging()
+
+class HTTPRangeFile(io.RawIOBase):
+    '''
+    Read-only, seekable file over a remote product. Reads are served from a
+    buffer filled by range requests of up to read_ahead bytes, which never
+    extend past limit, so reading one member does not fetch the next one.
+    '''
+
+    def __init__(self, session, url, length, validator=None, read_ahead=CHUNK_SIZE):
+        self.session = session
+        self.url = url
+        self.length = length
+        self.validator = validator
+        self.read_ahead = read_ahead
+        self.limit = length
+        self.position = 0
+        self.buffer = b''
+        self.buffer_start = 0
+        self.requests = 0
+        self.bytes_fetched = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.length
+        if offset < 0:
+            raise ValueError(f"Negative seek position {offset}")
+        self.position = offset
+        return self.position
+
+    def fetch(self, start, end):
+        '''
+        Returns bytes start to end (exclusive) of the remote file.
+        '''
+        headers = {'Range': f'bytes={start}-{end - 1}'}
+        if self.validator:
+            # The server sends the whole file instead if the product changed
+            headers['If-Range'] = self.validator
+        response = open_product_stream(self.session, self.url, headers)
+        try:
+            if response.status_code != 206:
+                response.raise_for_status()
+                raise IOError(f"{self.url} changed or does not support range requests")
+            range_start, _ = parse_content_range(response.headers.get('Content-Range'))
+            if range_start != start:
+                raise IOError(f"Server returned bytes from {range_start} instead of {start} for {self.url}")
+            data = response.content
+        finally:
+            response.close()
+        self.requests += 1
+        self.bytes_fetched += len(data)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length - self.position
+        end = min(self.position + size, self.length)
+        if end <= self.position:
+            return b''
+
+        if not (self.buffer_start <= self.position and end <= self.buffer_start + len(self.buffer)):
+            fetch_end = min(max(end, min(self.position + self.read_ahead, self.limit)), self.length)
+            self.buffer = self.fetch(self.position, fetch_end)
+            self.buffer_start = self.position
+
+        data = self.buffer[self.position - self.buffer_start:end - self.buffer_start]
+        self.position += len(data)
+        return data
+
+def get_product_relative_path(member_name):
+    '''
+    Returns the path of a member inside the product, e.g.
+    "PRODUCT.SAFE/annotation/s1a.xml" -> "annotation/s1a.xml".
+    '''
+    parts = member_name.strip('/').split('/', 1)
+    return parts[1] if len(parts) > 1 else parts[0]
+
+def select_members(infos, include_patterns):
+    '''
+    Returns the file members whose path inside the product matches any of
+    the fnmatch include_patterns (e.g. "manifest.safe", "annotation/*.xml").
+    '''
+    return [
+        info for info in infos
+        if not info.is_dir() and any(
+            fnmatch.fnmatch(get_product_relative_path(info.filename), pattern)
+            for pattern in include_patterns
+        )
+    ]
+
+def get_member_end_offsets(infos, central_directory_offset):
+    '''
+    Returns {member name: offset of the first byte after it in the archive},
+    i.e. where the next member (or the central directory) starts.
+    '''
+    infos = sorted(infos, key=lambda info: info.header_offset)
+    ends = {}
+    for info, next_info in zip(infos, infos[1:]):
+        ends[info.filename] = next_info.header_offset
+    if infos:
+        ends[infos[-1].filename] = central_directory_offset
+    return ends
+
+def place_members(staging_dir, storage_path):
+    '''
+    Move extracted files from staging_dir into storage_path, keeping any
+    other files of the product that are already stored there.
+    '''
+    for dirpath, _, filenames in os.walk(staging_dir):
+        relative_dir = os.path.relpath(dirpath, staging_dir)
+        target_dir = os.path.normpath(os.path.join(storage_path, relative_dir))
+        os.makedirs(target_dir, exist_ok=True)
+        for filename in filenames:
+            os.replace(os.path.join(dirpath, filename), os.path.join(target_dir, filename))
+
+def download_members(session, url, product_title, storage_path, include_patterns, chunk_size=CHUNK_SIZE):
+    '''
+    Fetch the members of the product zip at url matching include_patterns
+    and store them in storage_path, in the same layout a full extraction
+    would give. The files only appear in storage_path once every selected
+    member passed its CRC32 check.
+
+    Returns a dictionary of the members that failed and why.
+    '''
+    _, total_length, validator = probe_product(session, url)
+    if total_length is None:
+        raise IOError(f"{url} does not support range requests")
+
+    remote_file = HTTPRangeFile(session, url, total_length, validator, chunk_size)
+    staging_dir = get_staging_dir(f"{product_title}.zip", storage_path)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    os.makedirs(staging_dir)
+
+    failed_checks = {}
+    try:
+        with zipfile.ZipFile(remote_file) as zip_file:
+            infos = zip_file.infolist()
+            selected = select_members(infos, include_patterns)
+            if not selected:
+                raise IOError(f"No members of {product_title} match {include_patterns}")
+
+            end_offsets = get_member_end_offsets(infos, zip_file.start_dir)
+            for info in sorted(selected, key=lambda info: info.header_offset):
+                remote_file.limit = end_offsets[info.filename]
+                reason = extract_member_and_verify(zip_file, info, staging_dir, chunk_size)
+                if reason:
+                    failed_checks[info.filename] = reason
+
+        if failed_checks:
+            logger.error(f"------Integrity check failed for files: {sorted(failed_checks)}------")
+        else:
+            place_members(staging_dir, storage_path)
+            logger.info(f"------Stored {len(selected)} of {len(infos)} members of {product_title} in {storage_path}, fetched {remote_file.bytes_fetched} of {total_length} bytes in {remote_file.requests} requests------")
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+
+    return failed_checks
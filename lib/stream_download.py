@@ -0,0 +1,464 @@
+'''
+Helpers to stream product downloads to disk.
+
+Products are written in bounded chunks to a ".part" file next to the final
+filepath and only renamed to the final filepath once the whole body has been
+received, so a truncated download never looks like a finished product.
+
+Large products can also be fetched as several byte ranges over parallel
+connections into a preallocated ".part" file (download_segmented).
+
+When the checksum published by CDSE is known, the bytes are hashed while
+they stream in and a mismatching download is discarded before the rename.
+
+A small ".part.json" sidecar records the URL, expected length and validators
+(ETag/Last-Modified) of the download, so a later attempt (a retry or a new
+job) can resume the ".part" file with an HTTP Range request.
+'''
+
+import os
+import re
+import hashlib
+import json
+import threading
+from lib.utils import init_logging
+from lib.http_session import RequestTiming
+
+logger = init_logging()
+
+CHUNK_SIZE = 8 * 1024 * 1024 # 8 MiB per read keeps memory per worker constant
+PART_SUFFIX = '.part'
+SIDECAR_SUFFIX = '.part.json'
+SEGMENT_SIZE = 64 * 1024 * 1024
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+class ChecksumMismatch(IOError):
+    pass
+
+def new_hasher(algorithm):
+    '''
+    Returns a hash object for a checksum algorithm published by CDSE
+    (MD5 or BLAKE3), or None if the algorithm is not available here.
+    BLAKE3 needs the optional blake3 package.
+    '''
+    algorithm = algorithm.upper()
+    if algorithm == 'MD5':
+        return hashlib.md5()
+    if algorithm == 'BLAKE3':
+        try:
+            import blake3
+        except ImportError:
+            return None
+        return blake3.blake3()
+    return None
+
+def hash_file(hasher, filepath, chunk_size=CHUNK_SIZE):
+    '''
+    Feed the contents of filepath to hasher.
+    '''
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+    return hasher
+
+def verify_checksum(hasher, checksum, output_filepath):
+    '''
+    Raise ChecksumMismatch (and discard the partial download) if the hashed
+    bytes do not match checksum, an (algorithm, value) tuple.
+    '''
+    if hasher.hexdigest().lower() != checksum[1].lower():
+        discard_partial_download(output_filepath)
+        raise ChecksumMismatch(f"{checksum[0]} checksum mismatch for {output_filepath}: expected {checksum[1]}, got {hasher.hexdigest()}")
+    logger.info(f"------{checksum[0]} checksum verified for {os.path.basename(output_filepath)}------")
+
+def get_hasher(checksum, output_filepath):
+    if not checksum:
+        return None
+    hasher = new_hasher(checksum[0])
+    if hasher is None:
+        logger.warning(f"------Cannot verify {checksum[0]} checksum of {os.path.basename(output_filepath)}, algorithm not available------")
+    return hasher
+
+def is_partial_download(filepath):
+    '''
+    True if the file is an unfinished download (or belongs to one).
+    '''
+    return filepath.endswith(PART_SUFFIX) or filepath.endswith(SIDECAR_SUFFIX)
+
+def load_sidecar(output_filepath):
+    '''
+    Returns the recorded state of an unfinished download, or None.
+    '''
+    try:
+        with open(output_filepath + SIDECAR_SUFFIX, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+def save_sidecar(output_filepath, state):
+    '''
+    Atomically write the state of an unfinished download.
+    '''
+    sidecar_filepath = output_filepath + SIDECAR_SUFFIX
+    tmp_filepath = output_filepath + '.json' + PART_SUFFIX
+    with open(tmp_filepath, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_filepath, sidecar_filepath)
+
+def discard_partial_download(output_filepath):
+    '''
+    Remove the .part file and sidecar of a download, if any.
+    '''
+    for suffix in (PART_SUFFIX, SIDECAR_SUFFIX):
+        try:
+            os.remove(output_filepath + suffix)
+        except FileNotFoundError:
+            pass
+
+def parse_content_range(content_range):
+    '''
+    Parse a "bytes start-end/total" Content-Range header.
+    Returns (start, total), total is None if the server sent "*".
+    '''
+    match = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range or '')
+    if not match:
+        raise IOError(f"Invalid Content-Range header: {content_range}")
+    total = None if match.group(3) == '*' else int(match.group(3))
+    return int(match.group(1)), total
+
+def get_validator(headers):
+    '''
+    Returns a validator usable in If-Range: a strong ETag, else Last-Modified.
+    '''
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+def follow_redirects(session, url, headers=None):
+    '''
+    Follow the redirect chain by hand (so the Authorization header is kept
+    when CDSE redirects to the download host).
+    Returns the final streamed response and its URL.
+    '''
+    response = session.get(url, headers=headers, stream=True, allow_redirects=False)
+
+    while response.status_code in REDIRECT_CODES:
+        url = response.headers['Location']
+        response.close()
+        response = session.get(url, headers=headers, stream=True, allow_redirects=False)
+
+    return response, url
+
+def open_product_stream(session, url, headers=None):
+    '''
+    Returns the streamed response for url after redirects. The body of the
+    response has not been read yet.
+
+    If the session has a redirect_cache, a previously resolved download URL
+    is requested directly, skipping the catalogue round trip. The response
+    carries a RequestTiming as response.timing.
+    '''
+    redirect_cache = getattr(session, 'redirect_cache', None)
+    timing = RequestTiming(url)
+    request_url = (redirect_cache.lookup(url) if redirect_cache else None) or url
+
+    response, resolved_url = follow_redirects(session, request_url, headers)
+
+    if redirect_cache:
+        if request_url != url and response.status_code >= 400 and response.status_code != 416:
+            # The cached redirect is no longer valid, resolve it again
+            response.close()
+            redirect_cache.forget(url)
+            response, resolved_url = follow_redirects(session, url, headers)
+        if response.status_code < 400:
+            redirect_cache.store(url, resolved_url)
+
+    timing.headers_received()
+    response.timing = timing
+    return response
+
+def check_download_response(status, headers, offset, state, output_filepath):
+    '''
+    Check the response to a download request that resumes the .part file
+    at offset (0 for a fresh download), for both the thread and the asyncio
+    engines. status and headers are those of the response, which must
+    already have been checked for errors other than 416.
+
+    Returns (mode, expected_length): mode is None if the .part file is
+    already complete, 'ab' to append the body to it or 'wb' to restart it.
+    Raises IOError, discarding the partial download, if it cannot be resumed.
+    '''
+    if status == 416 and offset and offset == state.get('expected_length'):
+        # The previous attempt received everything but stopped before the rename
+        return None, offset
+    if status == 416:
+        discard_partial_download(output_filepath)
+        raise IOError(f"Server rejected resuming {output_filepath} at byte {offset}, restarting on next attempt")
+
+    if status == 206:
+        start, expected_length = parse_content_range(headers.get('Content-Range'))
+        if start != offset:
+            discard_partial_download(output_filepath)
+            raise IOError(f"Server resumed {output_filepath} at byte {start} instead of {offset}")
+        return 'ab', expected_length
+
+    if offset:
+        logger.info(f"------Server did not honour the range request, restarting {os.path.basename(output_filepath)}------")
+    expected_length = headers.get('Content-Length')
+    if expected_length is not None and 'Content-Encoding' not in headers:
+        # The body is decoded as it is read, so Content-Length only applies when unencoded.
+        return 'wb', int(expected_length)
+    return 'wb', None
+
+def check_download_length(output_filepath, expected_length):
+    '''
+    Returns the size of the .part file, raising IOError if it is not
+    expected_length. A .part file larger than that is discarded, since
+    resuming it can never succeed.
+    '''
+    written = os.path.getsize(output_filepath + PART_SUFFIX)
+    if expected_length is not None and written != expected_length:
+        if written > expected_length:
+            discard_partial_download(output_filepath)
+        raise IOError(f"Incomplete download of {output_filepath}: received {written} of {expected_length} bytes")
+    return written
+
+def download_resumable(session, url, output_filepath, chunk_size=CHUNK_SIZE, progress=None, checksum=None):
+    '''
+    Download url to output_filepath, resuming an earlier .part file if one
+    was left behind for the same url.
+
+    The resume request carries If-Range, so if the product changed on the
+    server (or the server ignores ranges) a full 200 response comes back and
+    the download restarts from zero. The .part file is only renamed to
+    output_filepath once its size matches the expected length.
+    progress, if given, is called with the size of every chunk written.
+
+    checksum, if given, is the (algorithm, value) published for the product.
+    The bytes are hashed as they are written (a resumed .part file is read
+    once to catch up) and the download is rejected if the hash differs.
+    '''
+    part_filepath = output_filepath + PART_SUFFIX
+    state = load_sidecar(output_filepath)
+    hasher = get_hasher(checksum, output_filepath)
+    headers = {}
+    offset = 0
+
+    # A segmented .part file is preallocated, so its size says nothing about progress
+    if state and state.get('url') == url and not state.get('segmented') and os.path.exists(part_filepath):
+        offset = os.path.getsize(part_filepath)
+    else:
+        # Stale or unknown partial download, start from scratch
+        discard_partial_download(output_filepath)
+
+    if offset:
+        headers['Range'] = f'bytes={offset}-'
+        if state.get('validator'):
+            headers['If-Range'] = state['validator']
+        logger.info(f"------Resuming {os.path.basename(output_filepath)} from byte {offset}------")
+
+    response = open_product_stream(session, url, headers)
+    try:
+        if response.status_code != 416:
+            response.raise_for_status()
+        mode, expected_length = check_download_response(response.status_code, response.headers, offset, state, output_filepath)
+    except Exception:
+        response.close()
+        raise
+
+    if mode is None:
+        response.close()
+        if hasher:
+            hash_file(hasher, part_filepath, chunk_size)
+    else:
+        if mode == 'ab':
+            if hasher:
+                hash_file(hasher, part_filepath, chunk_size)
+        else:
+            offset = 0
+
+        save_sidecar(output_filepath, {
+            'url': url,
+            'expected_length': expected_length,
+            'validator': get_validator(response.headers),
+        })
+
+        try:
+            with open(part_filepath, mode) as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        if hasher:
+                            hasher.update(chunk)
+                        if progress:
+                            progress(len(chunk))
+        finally:
+            response.close()
+        response.timing.finished(os.path.getsize(part_filepath) - offset)
+
+    written = check_download_length(output_filepath, expected_length)
+
+    if hasher:
+        verify_checksum(hasher, checksum, output_filepath)
+
+    os.replace(part_filepath, output_filepath)
+    discard_partial_download(output_filepath)
+    return written
+
+def probe_product(session, url):
+    '''
+    Ask for the first byte of url to find out whether the server honours
+    range requests. Returns (resolved_url, total_length, validator), with
+    total_length None if ranges are not supported.
+    '''
+    response = open_product_stream(session, url, {'Range': 'bytes=0-0'})
+    try:
+        if response.status_code != 206:
+            response.raise_for_status()
+            return url, None, None
+        _, total_length = parse_content_range(response.headers.get('Content-Range'))
+        return getattr(response, 'url', url), total_length, get_validator(response.headers)
+    finally:
+        response.close()
+
+def preallocate(fd, length):
+    '''
+    Reserve length bytes for the file, falling back to a sparse file where
+    the filesystem does not support fallocate.
+    '''
+    try:
+        os.posix_fallocate(fd, 0, length)
+    except (AttributeError, OSError):
+        os.ftruncate(fd, length)
+
+def download_segmented(session, url, output_filepath, expected_length, validator=None,
+                       segment_size=SEGMENT_SIZE, connections_per_product=4,
+                       connection_slots=None, chunk_size=CHUNK_SIZE, resolved_url=None, progress=None,
+                       checksum=None):
+    '''
+    Download url as byte ranges of segment_size fetched over up to
+    connections_per_product connections, written in place with pwrite into
+    a preallocated .part file.
+
+    The calling thread is expected to hold one slot of connection_slots
+    (a semaphore shared with the whole-product workers). Extra connections
+    are only opened when a slot is free, so segments never exceed the global
+    connection budget and never wait on it. Completed segments are recorded
+    in the sidecar, so an interrupted download only refetches the missing ones.
+
+    Segments arrive out of order, so a checksum is verified by reading the
+    finished .part file once, before it is renamed.
+    '''
+    part_filepath = output_filepath + PART_SUFFIX
+    fetch_url = resolved_url or url
+    state = load_sidecar(output_filepath)
+
+    if not (state and state.get('segmented') and state.get('url') == url
+            and state.get('expected_length') == expected_length
+            and state.get('validator') == validator and os.path.exists(part_filepath)):
+        discard_partial_download(output_filepath)
+        state = {
+            'url': url,
+            'expected_length': expected_length,
+            'validator': validator,
+            'segmented': True,
+            'segment_size': segment_size,
+            'done': [],
+        }
+        fd = os.open(part_filepath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            preallocate(fd, expected_length)
+        finally:
+            os.close(fd)
+        save_sidecar(output_filepath, state)
+    elif state['done']:
+        logger.info(f"------Resuming {os.path.basename(output_filepath)}, {len(state['done'])} segments already downloaded------")
+
+    segment_size = state['segment_size']
+    done = set(state['done'])
+    pending = [start for start in range(0, expected_length, segment_size) if start not in done]
+    lock = threading.Lock()
+    errors = []
+
+    fd = os.open(part_filepath, os.O_WRONLY)
+
+    def fetch_segment(start):
+        end = min(start + segment_size, expected_length) - 1
+        headers = {'Range': f'bytes={start}-{end}'}
+        if validator:
+            headers['If-Range'] = validator
+        response = open_product_stream(session, fetch_url, headers)
+        try:
+            if response.status_code != 206:
+                response.raise_for_status()
+                raise IOError(f"Server did not honour range {start}-{end} of {output_filepath}")
+            if parse_content_range(response.headers.get('Content-Range'))[0] != start:
+                raise IOError(f"Server returned the wrong range for segment {start}-{end} of {output_filepath}")
+            offset = start
+            for chunk in response.iter_content(chunk_size=chunk_size):
+                view = memoryview(chunk)
+                while view:
+                    written = os.pwrite(fd, view, offset)
+                    offset += written
+                    view = view[written:]
+                if progress:
+                    progress(len(chunk))
+        finally:
+            response.close()
+        response.timing.finished(offset - start)
+        if offset != end + 1:
+            raise IOError(f"Incomplete segment {start}-{end} of {output_filepath}: stopped at byte {offset}")
+
+    def fetch_segments():
+        while True:
+            with lock:
+                if errors or not pending:
+                    return
+                start = pending.pop(0)
+            try:
+                fetch_segment(start)
+            except Exception as e:
+                with lock:
+                    errors.append(e)
+                return
+            with lock:
+                done.add(start)
+                state['done'] = sorted(done)
+                save_sidecar(output_filepath, state)
+
+    def fetch_segments_and_release():
+        try:
+            fetch_segments()
+        finally:
+            connection_slots.release()
+
+    helpers = []
+    try:
+        for _ in range(min(connections_per_product, len(pending)) - 1):
+            if connection_slots is None:
+                helper = threading.Thread(target=fetch_segments, daemon=True)
+            elif connection_slots.acquire(blocking=False):
+                helper = threading.Thread(target=fetch_segments_and_release, daemon=True)
+            else:
+                break
+            helper.start()
+            helpers.append(helper)
+
+        fetch_segments()
+        for helper in helpers:
+            helper.join()
+    finally:
+        os.close(fd)
+
+    if errors:
+        raise errors[0]
+
+    hasher = get_hasher(checksum, output_filepath)
+    if hasher:
+        verify_checksum(hash_file(hasher, part_filepath, chunk_size), checksum, output_filepath)
+
+    os.replace(part_filepath, output_filepath)
+    discard_partial_download(output_filepath)
+    logger.info(f"------Downloaded {os.path.basename(output_filepath)} in segments over {len(helpers) + 1} connections------")
+    return expected_length
@@ -0,0 +1,120 @@
+'''
+Durable progress of the query loop, per collection.
+
+    watermark  start of the next window the live loop will query, and the
+               window length learned for the collection (adaptive windows)
+    windows    windows that were queried, finished or failed
+
+The state is kept in an SQLite database (sync_state_db in the config). Each
+window is recorded and the watermark moved in one transaction, so a crash
+never leaves the two out of step. Failed windows stay in the database until
+a retry succeeds, instead of being skipped for good. Finished windows are
+only kept so a backfill can resume, and are pruned once they are old (see
+prune_windows).
+
+The start_timestamp in the mission config only seeds the watermark of a
+collection the first time it is queried.
+'''
+
+import sqlite3
+import threading
+import time
+
+FINISHED = 'finished'
+FAILED = 'failed'
+
+class SyncState:
+
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS watermarks (
+                    collection TEXT PRIMARY KEY,
+                    start_timestamp TEXT,
+                    window_minutes REAL,
+                    updated_at REAL
+                )
+            """)
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(watermarks)")]
+            if 'window_minutes' not in columns:
+                self.conn.execute("ALTER TABLE watermarks ADD COLUMN window_minutes REAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS windows (
+                    collection TEXT,
+                    start TEXT,
+                    end TEXT,
+                    status TEXT,
+                    attempts INTEGER DEFAULT 0,
+                    updated_at REAL,
+                    PRIMARY KEY (collection, start, end)
+                )
+            """)
+            self.conn.execute("CREATE INDEX IF NOT EXISTS windows_status ON windows (collection, status)")
+
+    def get_watermark(self, collection, default=None):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT start_timestamp FROM watermarks WHERE collection = ?", (collection,)
+            ).fetchone()
+        return row[0] if row else default
+
+    def get_window_minutes(self, collection, default=None):
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT window_minutes FROM watermarks WHERE collection = ?", (collection,)
+            ).fetchone()
+        return row[0] if row and row[0] is not None else default
+
+    def record_window(self, collection, window, finished, next_start=None, window_minutes=None):
+        '''
+        Record a window as finished or failed and, if next_start is given,
+        move the watermark to it (and store the length of the next window,
+        if given), in one transaction.
+        '''
+        now = time.time()
+        with self._lock, self.conn:
+            self.conn.execute("""
+                INSERT INTO windows (collection, start, end, status, attempts, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?)
+                ON CONFLICT (collection, start, end) DO UPDATE SET
+                    status = excluded.status, attempts = attempts + 1, updated_at = excluded.updated_at
+            """, (collection, *window, FINISHED if finished else FAILED, now))
+            if next_start is not None:
+                self.conn.execute("""
+                    INSERT INTO watermarks (collection, start_timestamp, window_minutes, updated_at)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (collection) DO UPDATE SET
+                        start_timestamp = excluded.start_timestamp,
+                        window_minutes = COALESCE(excluded.window_minutes, window_minutes),
+                        updated_at = excluded.updated_at
+                """, (collection, next_start, window_minutes, now))
+
+    def get_windows(self, collection, status, max_attempts=None):
+        '''
+        Returns the (start, end) of the windows of a collection with the given
+        status, oldest first, optionally only those tried fewer than max_attempts times.
+        '''
+        query = "SELECT start, end FROM windows WHERE collection = ? AND status = ?"
+        parameters = [collection, status]
+        if max_attempts is not None:
+            query += " AND attempts < ?"
+            parameters.append(max_attempts)
+        with self._lock:
+            return self.conn.execute(query + " ORDER BY start", parameters).fetchall()
+
+    def prune_windows(self, collection, older_than):
+        '''
+        Delete the finished windows of a collection last updated before
+        older_than (a time.time() timestamp). Returns the number deleted.
+        '''
+        with self._lock, self.conn:
+            return self.conn.execute(
+                "DELETE FROM windows WHERE collection = ? AND status = ? AND updated_at < ?",
+                (collection, FINISHED, older_than)
+            ).rowcount
+
+    def close(self):
+        self.conn.close()
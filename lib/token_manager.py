@@ -0,0 +1,135 @@
+'''
+One access token for every download worker in the process.
+
+The token is renewed shortly before it expires, using the refresh_token grant
+while the refresh token is still valid and the password grant otherwise.
+Only one thread talks to the identity server at a time, the others wait for
+its result instead of all refreshing at once.
+'''
+
+import threading
+import time
+import requests
+from requests.auth import AuthBase
+from lib.utils import init_logging
+
+logger = init_logging()
+
+TOKEN_URL = 'https://identity.dataspace.copernicus.eu/auth/realms/CDSE/protocol/openid-connect/token'
+REFRESH_MARGIN = 60 # Renew tokens this many seconds before they expire
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+
+class TokenManager:
+
+    def __init__(self, username, password, refresh_margin=REFRESH_MARGIN):
+        self.username = username
+        self.password = password
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.token_expiry = 0
+        self.refresh_token = None
+        self.refresh_token_expiry = 0
+        self.token_fetches = 0
+        self._lock = threading.Lock()
+
+    def _is_valid(self):
+        return self.access_token and time.time() < self.token_expiry - self.refresh_margin
+
+    def get_token(self):
+        '''
+        Returns a valid access token, renewing it if it expires within refresh_margin seconds.
+        '''
+        with self._lock:
+            if not self._is_valid():
+                self._fetch_token()
+            return self.access_token
+
+    def refresh(self, stale_token):
+        '''
+        Renew the access token after the server rejected stale_token (HTTP 401).
+        If another thread already replaced stale_token, its token is returned instead.
+        '''
+        with self._lock:
+            if self.access_token != stale_token and self._is_valid():
+                return self.access_token
+            self._fetch_token()
+            return self.access_token
+
+    def _fetch_token(self):
+        payload = None
+        if self.refresh_token and time.time() < self.refresh_token_expiry - self.refresh_margin:
+            payload = {
+                'grant_type': 'refresh_token',
+                'refresh_token': self.refresh_token,
+                'client_id': 'cdse-public'
+            }
+            response = requests.post(TOKEN_URL, data=payload)
+            self.token_fetches += 1
+            if response.status_code != 200:
+                logger.warning(f"------Refresh token rejected ({response.status_code}), logging in again------")
+                payload = None
+
+        if payload is None:
+            payload = {
+                'grant_type': 'password',
+                'username': self.username,
+                'password': self.password,
+                'client_id': 'cdse-public'
+            }
+            response = requests.post(TOKEN_URL, data=payload)
+            self.token_fetches += 1
+            if response.status_code != 200:
+                # Raise an exception with the error message if the request fails
+                raise Exception(f"Error: {response.status_code} - {response.text}")
+
+        token = response.json()
+        now = time.time()
+        self.access_token = token['access_token']
+        self.token_expiry = now + token['expires_in']
+        self.refresh_token = token.get('refresh_token')
+        self.refresh_token_expiry = now + token.get('refresh_expires_in', 0)
+        logger.info(f"------Fetched access token with {payload['grant_type']} grant ({self.token_fetches} token requests so far)------")
+
+class TokenAuth(AuthBase):
+    '''
+    requests auth that adds the current access token to every request and
+    transparently repeats a request once with a renewed token on HTTP 401.
+    '''
+
+    def __init__(self, token_manager):
+        self.token_manager = token_manager
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f'Bearer {self.token_manager.get_token()}'
+        request.register_hook('response', self.handle_401)
+        return request
+
+    def handle_401(self, response, **kwargs):
+        if response.status_code != 401 or getattr(response.request, 'token_renewed', False):
+            return response
+
+        stale_token = response.request.headers['Authorization'][len('Bearer '):]
+        token = self.token_manager.refresh(stale_token)
+
+        # Release the connection before sending the request again
+        response.content
+        response.close()
+
+        request = response.request.copy()
+        request.headers['Authorization'] = f'Bearer {token}'
+        request.token_renewed = True
+        retried_response = response.connection.send(request, **kwargs)
+        retried_response.history.append(response)
+        retried_response.request = request
+        return retried_response
+
+def get_token_manager(username, password):
+    '''
+    Returns the TokenManager shared by every worker using these credentials.
+    '''
+    with _token_managers_lock:
+        if username not in _token_managers:
+            _token_managers[username] = TokenManager(username, password)
+        return _token_managers[username]
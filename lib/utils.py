@@ -1,11 +1,12 @@
 import yaml
-from datetime import date
+from datetime import date, datetime, timezone
 from shapely.wkt import loads
 from shapely.geometry import shape
 import logging
 import sys
 import os
 import pandas as pd
+from lib.filename_parser import get_short_name, predict_base_paths
 
 def date_from_string(date_string):
     '''
@@ -17,6 +18,13 @@ def date_from_string(date_string):
 
     return date(year,month,day)
 
+def get_cutoff_time(cutoff):
+    '''
+    Converts a "HH:MM" cutoff time to a UTC timestamp today
+    '''
+    hour, minute = (int(value) for value in cutoff.split(':'))
+    return datetime.now(timezone.utc).replace(hour=hour, minute=minute, second=0, microsecond=0)
+
 def load_values_from_config(config_file = 'config.yaml'):
     with open(config_file, 'r') as yaml_file:
         config_data = yaml.safe_load(yaml_file)
@@ -63,30 +71,15 @@ def load_and_combine_configs(mission_config_filepath, general_config_filepath):
     combined_config = {**general_config, **mission_config}
     return combined_config
 
-def update_time_in_config(filepath, start_dt, next_start_dt):
-    """
-    Replace all occurrences of start_dt with next_start_dt in the given file.
-
-    Args:
-        filepath (str): Path to the file to be updated.
-        start_dt (str): The datetime string to be replaced.
-        next_start_dt (str): The new datetime string to insert.
-    """
-    with open(filepath, 'r', encoding='utf-8') as file:
-        contents = file.read()
-
-    updated_contents = contents.replace(start_dt, next_start_dt)
-
-    with open(filepath, 'w', encoding='utf-8') as file:
-        file.write(updated_contents)
-
 def init_logging():
     # Log to console
     logger = logging.getLogger()
     logger.setLevel(logging.DEBUG)
-    log_info = logging.StreamHandler(sys.stdout)
-    log_info.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-    logger.addHandler(log_info)
+    # Every module calls this on import, only attach the console handler once
+    if not logger.handlers:
+        log_info = logging.StreamHandler(sys.stdout)
+        log_info.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        logger.addHandler(log_info)
     return logger
 
 def get_dict_satellites_and_product_types(sat):
@@ -159,43 +152,17 @@ def get_product_metadata(product_metadata_df, esa_product_type):
     else:
         return {}
 
-def predict_base_path(filename, root_path, product_metadata_csv):
+def extract_short_name_by_mission(product_name):
+    # Kept for existing callers, see lib/filename_parser.py
+    return get_short_name(product_name)
 
-    if filename.startswith('S1'):
-        filename_product_type = filename.split('_')[1] + '_' + filename.split('_')[2]
-        if filename_product_type.startswith('S'):
-            filename_product_type = filename[4:14]
-    elif filename.startswith('S2'):
-        filename_product_type = filename.split('_')[1]
-    elif filename.startswith('S3'):
-        filename_product_type = filename[4:15]
-    elif filename.startswith('S5'):
-        filename_product_type = filename[9:19]
-
-    platform = filename.split('_')[0]
-    mission = filename[0:2]
-    product_metadata_df = pd.read_csv(product_metadata_csv)
-    product_metadata = get_product_metadata(product_metadata_df,filename_product_type)
-
-    if mission == 'S1':
-        date = filename[17:25]
-        mode = filename[4:6]
-    elif mission == 'S2':
-        date = filename[11:19]
-    elif mission == 'S3':
-        date = filename[16:24]
-    elif mission == 'S5':
-        date = filename[20:28]
-
-    year = date[:4]
-    month = date[4:6]
-    day = date[6:]
-
-    if mission in ['S3', 'S5']:
-        url = f'{root_path}{platform}/{year}/{month}/{day}/{product_metadata["product_type"]}/'
-    elif mission == 'S1':
-        url = f'{root_path}{platform}/{year}/{month}/{day}/{mode}/'
-    elif mission == 'S2':
-        url = f'{root_path}{platform}/{year}/{month}/{day}/'
-
-    return url
\ No newline at end of file
+def predict_base_path(filename, root_path, product_metadata_csv):
+    '''
+    Returns the storage directory of a product, see lib/filename_parser.py
+    (predict_base_paths) to predict the directories of many products at once.
+    Raises ValueError if the mission or product type of the product is unknown.
+    '''
+    base_path = predict_base_paths([filename], root_path, product_metadata_csv)[0]
+    if base_path is None:
+        raise ValueError(f"Cannot predict the storage path of {filename}: unknown mission or product type")
+    return base_path
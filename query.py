@@ -30,8 +30,8 @@ def main(args):
 
     for satellite, productTypes in satellites_and_product_types.items():
         for productType in productTypes:
-            metadata_products = Metadata_products(satellite, productType, start_date, end_date)
-            metadata_products.harvest_all_products_to_json()
+            metadata_products = Metadata_products(satellite, productType, start_date, end_date, ndjson=args.ndjson)
+            metadata_products.harvest_all_products_to_json(args.concurrent_pages)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script to downloaded products from CDSE between two given dates")
@@ -39,6 +39,8 @@ if __name__ == "__main__":
     parser.add_argument("--start_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--end_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--sat", type=str, required=True, help="For which satellite do you want to harvest products?", choices=valid_satellites)
+    parser.add_argument("--ndjson", action="store_true", help="Write the products as newline-delimited JSON as they are harvested, instead of one JSON array")
+    parser.add_argument("--concurrent_pages", type=int, default=4, help="Number of result pages fetched at a time")
 
     args = parser.parse_args()
     main(args)
@@ -30,8 +30,8 @@ def main(args):
     satellites_and_product_types = get_dict_satellites_and_product_types(args.sat)
 
     try:
-        access_token = get_access_token()
-        # Do something with the access token here
+        # Fail early on bad credentials, the downloads reuse the cached token
+        get_access_token()
     except Exception as e:
         # Print the error message and exit
         logger.error(e)
@@ -39,11 +39,11 @@ def main(args):
 
     for satellite, productTypes in satellites_and_product_types.items():
         for productType in productTypes:
-            metadata_products = Metadata_products(satellite, productType, start_date, end_date)
-            metadata_products.harvest_all_products_to_json()
+            metadata_products = Metadata_products(satellite, productType, start_date, end_date, ndjson=args.ndjson)
+            metadata_products.harvest_all_products_to_json(args.concurrent_pages)
             products = metadata_products.get_product_ids_and_titles()
             for product_id,product_title in products.items():
-                download_product(product_id, product_title, access_token)
+                download_product(product_id, product_title)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Script to downloaded products from CDSE between two given dates")
@@ -51,6 +51,8 @@ if __name__ == "__main__":
     parser.add_argument("--start_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--end_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--sat", type=str, required=True, help="For which satellite do you want to harvest products?", choices=valid_satellites)
+    parser.add_argument("--ndjson", action="store_true", help="Write the products as newline-delimited JSON as they are harvested, instead of one JSON array")
+    parser.add_argument("--concurrent_pages", type=int, default=4, help="Number of result pages fetched at a time")
 
     args = parser.parse_args()
     main(args)
@@ -16,11 +16,14 @@ TO DO:
     It should have the same filename as the product but different extension, and be stored in the metadatasubdirectory.
 """
 import argparse
+import concurrent.futures
 from lib.metadata_products import Metadata_products
 from lib.utils import load_values_from_config, init_logging, get_dict_satellites_and_product_types
-from lib.download_products import download_product, get_access_token, unzip_and_store
+from lib.download_products import download_product, unzip_and_store
+from lib.inventory import build_inventory, inventory_exists, record_products
 import sys
 import os
+import yaml
 
 (
     username,
@@ -32,6 +35,10 @@ import os
     product_types_csv
 ) = load_values_from_config(config_file='./config.yaml')
 
+# Optional inventory of the products in storage (see lib/inventory.py)
+with open('./config.yaml', 'r') as yaml_file:
+    inventory_db = yaml.safe_load(yaml_file).get('inventory_db')
+
 # Log to console
 logger = init_logging()
 
@@ -46,6 +53,11 @@ def main(args):
 
     satellites_and_product_types = get_dict_satellites_and_product_types(args.sat)
 
+    if inventory_db and not inventory_exists(inventory_db):
+        build_inventory(inventory_db, output_dir)
+
+    pool = concurrent.futures.ProcessPoolExecutor(max_workers=args.extraction_workers)
+
     # try:
     #     access_token = get_access_token()
     #     # Do something with the access token here
@@ -68,24 +80,33 @@ def main(args):
             metadata_products.create_products_metadata_dict()
 
             # Filter out products that are already stored
-            filtered_products, filtered_storage_paths = metadata_products.filter_out_synced_products()
+            filtered_products, filtered_storage_paths = metadata_products.filter_out_synced_products(inventory_db)
 
+            extractions = {}
             for product_id in filtered_products:
                 product_title = filtered_products[product_id]
                 storage_path = filtered_storage_paths[product_id]
-                # get or refresh access token if necessary
-                access_token = get_access_token()
+                download_product(product_id, product_title)
+                # Extract in a worker process while the next product downloads
+                extractions[pool.submit(unzip_and_store, product_title, storage_path)] = product_id
 
-                download_product(product_id, product_title, access_token)
-                success = unzip_and_store(product_title, storage_path)
-                if success:
+            for future in concurrent.futures.as_completed(extractions):
+                if future.result():
+                    product_id = extractions[future]
                     metadata_products.store_individual_product_metadata(product_id)
+                    if inventory_db:
+                        storage_path = filtered_storage_paths[product_id]
+                        record_products(inventory_db, [
+                            os.path.join(storage_path, name) for name in os.listdir(storage_path)
+                            if name.startswith(filtered_products[product_id])
+                        ])
 
 
             # Remove JSON once all products are downloaded and stored
             logger.info(f"------Removing: {metadata_products.filepath}------")
             #os.remove(metadata_products.filepath)
 
+    pool.shutdown()
     return 0
 
 if __name__ == "__main__":
@@ -94,6 +115,7 @@ if __name__ == "__main__":
     parser.add_argument("--start_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--end_date", type=str, required=True, help="First date you want to download products for (yyyymmdd)")
     parser.add_argument("--sat", type=str, required=True, help="For which satellite do you want to harvest products?", choices=valid_satellites)
+    parser.add_argument("--extraction_workers", type=int, default=os.cpu_count(), help="Number of processes extracting products in parallel")
 
     args = parser.parse_args()
     main(args)
@@ -8,151 +8,138 @@ PLAN:
 6. End job after 23.5 hours, leaving 0.5 hours before next job submitted on crontab.
 '''
 
-import os
 import time
-import sqlite3
 import argparse
 from datetime import datetime, timezone
 import sys
 
-from lib.utils import init_logging, load_and_combine_configs
-from lib.parallel_download import download_list_of_products
+from lib.utils import init_logging, load_and_combine_configs, get_cutoff_time
+from lib.download_queue import (
+    LEASE_SECONDS, LeaseKeeper, get_connection, get_product_checksums, update_number_of_attempts,
+    remove_repeated_failures_from_queue, remove_products_from_queue
+)
+from lib.parallel_download import download_list_of_products, download_queue_in_lanes
+from lib.pipeline import download_queue_in_pipeline
 
-def update_number_of_attempts(failures, db_path):
+def report_download_results(successes, failures, config, leases):
     """
-    Increments the 'attempts' value by 1 for each product name in the failures list.
-
-    Parameters:
-        failures (list of str): List of product names to update.
-        db_path (str): Path to the SQLite database.
+    Remove downloaded products from the queue and count a failed attempt for
+    the others, which are given back to the queue for any worker to retry
+    after failed_retry_delay seconds.
     """
-    if not failures:
-        return  # Nothing to do
-
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-
-    try:
-        for failed_id, failed_name in failures:
-            cur.execute("""
-                UPDATE products
-                SET attempts = attempts + 1
-                WHERE id = ?
-            """, (failed_id,))
-        conn.commit()
-    finally:
-        conn.close()
+    db_path = config['product_download_queue_db']
+    leases.done(successes + failures)
+    remove_products_from_queue(successes, db_path)
+    update_number_of_attempts(failures, db_path, config.get('failed_retry_delay', 600))
+    remove_repeated_failures_from_queue(failures, db_path, config['limit_download_attempts'])
 
-def remove_repeated_failures_from_queue(failures, db_path, limit_download_attempts):
+def run_download_lanes(config, leases):
     """
-    Removes products from the queue if they have failed 3 or more times.
-
-    Parameters:
-        failures (list of str): List of product ids to check.
-        db_path (str): Path to the SQLite database.
+    Download the queue in two lanes, small and large products, each with its
+    own workers. A lane starts the next product as soon as one of its workers
+    is free, so large products never hold up small ones.
     """
-    if not failures:
-        return  # Nothing to do
-
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
-
-    try:
-        for failed_id, failed_name in failures:
-            cur.execute("""
-                DELETE FROM products
-                WHERE id = ? AND attempts >= ?
-            """, (failed_id,limit_download_attempts))
-        conn.commit()
-    finally:
-        conn.close()
-
-def get_products_to_download(db_path, limit):
+    db_path = config['product_download_queue_db']
+    threshold = config['small_product_threshold']
+    lanes = [
+        {'name': 'small', 'min_size': None, 'max_size': threshold,
+         'parallel_downloads': config.get('small_lane_parallel_downloads', config['max_parallel_downloads'])},
+        {'name': 'large', 'min_size': threshold, 'max_size': None,
+         'parallel_downloads': config.get('large_lane_parallel_downloads', config['max_parallel_downloads'])},
+    ]
+
+    checksums = {}
+
+    def fetch_products(lane, limit):
+        # Products in flight are leased to this worker, and failed products
+        # are held back by the queue, so neither is claimed again
+        products = leases.claim(limit, lane['min_size'], lane['max_size'])
+        checksums.update(get_product_checksums(products, db_path))
+        return products
+
+    def report_results(successes, failures):
+        report_download_results(successes, failures, config, leases)
+
+    download_queue_in_lanes(lanes, config, fetch_products, report_results, checksums)
+
+def run_download_pipeline(config, leases):
+    """
+    Download, verify and store the queue in a pipeline of stages (see
+    lib/pipeline.py). Products leave the queue once they are stored in
+    output_dir rather than when they are downloaded.
     """
-    Retrieves the first `limit` product ids and names from the queue.
+    db_path = config['product_download_queue_db']
+    checksums = {}
 
-    Parameters:
-        db_path (str): Path to the SQLite database.
-        limit (int): Number of products to retrieve.
+    def fetch_products(limit):
+        # Products in the pipeline are leased to this worker, and failed
+        # products are held back by the queue, so neither is claimed again
+        products = leases.claim(limit)
+        checksums.update(get_product_checksums(products, db_path))
+        return products
 
-    Returns:
-        list of tuples: Each tuple contains (id, name) of a product to download.
-    """
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+    def report_results(successes, failures):
+        report_download_results(successes, failures, config, leases)
 
-    try:
-        cur.execute("""
-            SELECT id, name FROM products
-            ORDER BY ROWID ASC
-            LIMIT ?
-        """, (limit,))
-        return cur.fetchall()  # This will be a list of (id, name) tuples
-    finally:
-        conn.close()
+    download_queue_in_pipeline(config, fetch_products, report_results, checksums, leases.release)
 
-def remove_products_from_queue(products, db_path):
-    """
-    Removes products from the queue based on their ids.
+def run_download(
+        mission_config_path
+    ):
 
-    Parameters:
-        ids (list of str): Product ids to remove.
-        db_path (str): Path to the SQLite database.
-    """
-    if not products:
-        return  # Nothing to do
+    config = load_and_combine_configs(mission_config_path, 'config/config.yaml')
 
-    conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+    # Create the queue, or add the columns and indexes missing from queues created by older versions.
+    # Use journal mode DELETE if workers on several nodes share the queue over a network file system.
+    get_connection(config['product_download_queue_db'], config.get('queue_journal_mode', 'WAL'))
 
+    # Products are leased to this worker while it downloads them, so other
+    # workers draining the same queue skip them. Leases still held when the
+    # job ends are given back to the queue.
+    leases = LeaseKeeper(config['product_download_queue_db'], config.get('lease_seconds', LEASE_SECONDS))
     try:
-        for id, name in products:
-            cur.execute("""
-                DELETE FROM products
-                WHERE id = ?
-            """, (id,))
-        conn.commit()
+        if config.get('pipeline'):
+            run_download_pipeline(config, leases)
+        elif config.get('small_product_threshold'):
+            run_download_lanes(config, leases)
+        else:
+            run_download_batches(config, leases)
     finally:
-        conn.close()
+        leases.close()
 
-def run_download(
-        mission_config_path
-    ):
+    cutoff = get_cutoff_time(config.get('download_cutoff', '23:30'))
+    sys.exit(f"Current time is after {cutoff.time()}. Terminating before querying starts again in new job.")
 
+def run_download_batches(config, leases):
+    """
+    Download the queue a batch of number_downloads_per_iteration products at a time.
+    """
     logger = init_logging()
-    config = load_and_combine_configs(mission_config_path, 'config/config.yaml')
 
     while True:
 
         # If time after cutoff, terminate the job.
         now = datetime.now(timezone.utc)
-        cutoff = now.replace(hour=23, minute=30, second=0, microsecond=0)
+        cutoff = get_cutoff_time(config.get('download_cutoff', '23:30'))
         if now > cutoff:
-            sys.exit(f"Current time is after {cutoff.time()}. Terminating before querying starts again in new job.")
+            return
 
-        # Make a list of the first N rows in the database
+        # Claim the first N rows in the database not claimed by another worker
         # list of tuples [(id, product_name), (id, product_name)...]
-        products_to_download = get_products_to_download(
-            config['product_download_queue_db'],
-            config['number_downloads_per_iteration']
-        )
+        products_to_download = leases.claim(config['number_downloads_per_iteration'])
 
         if len(products_to_download) > 0:
-            # Download products in list
-            successes, failures = download_list_of_products(products_to_download, config)
+            # Download products in list, verifying them against their published checksums
+            checksums = get_product_checksums(products_to_download, config['product_download_queue_db'])
+            successes, failures = download_list_of_products(products_to_download, config, checksums)
 
             # midpoint = len(products_to_download) // 2
             # successes = products_to_download[:midpoint]
             # failures = products_to_download[midpoint:]
 
-            # Remove successfully downloaded products from the download queue database
-            remove_products_from_queue(successes, config['product_download_queue_db'])
-
-            # Update attempts column adding 1
-            update_number_of_attempts(failures, config['product_download_queue_db'])
-
-            # If attempted too many times, remove from queue.
-            remove_repeated_failures_from_queue(failures, config['product_download_queue_db'], config['limit_download_attempts'])
+            # Remove successfully downloaded products from the download queue database,
+            # add 1 to the attempts of the others and remove those attempted too many times
+            report_download_results(successes, failures, config, leases)
 
             # Consider logging failures to check up
             #time.sleep(3)
@@ -1,4 +1 @@
-# TODO: Run on bigmem
-# TODO: 6 parallel downloads 128 Gb memory limit
-
 python3 sync_download.py -c ./config/s3_config.yaml
\ No newline at end of file
@@ -1,15 +1,19 @@
-import requests
 from datetime import datetime, timedelta, timezone
 import sys
 import os
 import time
-import sqlite3
 import argparse
-import pandas as pd
 import glob
 import re
-import gc
-from lib.utils import load_and_combine_configs, init_logging, update_time_in_config, predict_base_path
+import heapq
+import itertools
+from lib.utils import load_and_combine_configs, init_logging
+from lib.download_queue import add_products
+from lib.http_session import get_query_session
+from lib.filename_parser import get_short_names, predict_base_paths
+from lib.inventory import build_inventory, inventory_exists, get_stored_short_names
+from lib.backfill import RateLimiter, parse_timestamp, format_timestamp, split_into_windows, run_backfill
+from lib.sync_state import SyncState, FAILED
 
 # TODO: Create start, stop, restart scripts that execute both the query and download jobs as subprocesses.
 # They need their own separate bash scripts (on qsub) to run. Stopping them could be challenging as this will require the job ID.
@@ -18,35 +22,93 @@ from lib.utils import load_and_combine_configs, init_logging, update_time_in_con
 def no_matches(path_pattern):
     return not glob.glob(path_pattern + '*')
 
-def extract_short_name_by_mission(product_name):
-    mission = product_name[:2]
-
-    if mission in ['S1', 'S3', 'S5', 'S6']:
-        # These missions usually have two timestamps, use the second one as sensing date
-        match = re.match(r'^(.*?\d{8}T\d{6}_\d{8}T\d{6})', product_name)
-    elif mission == 'S2':
-        # S2 products typically only have one timestamp (sensing time)
-        match = re.match(r'^(.*?\d{8}T\d{6})', product_name)
+def get_preferred_checksum(checksums):
+    '''
+    Returns (algorithm, value) of the checksum to verify downloads against,
+    from the OData Checksum attribute. MD5 is preferred since it needs no
+    extra package, BLAKE3 is used when no MD5 is published.
+    '''
+    if not isinstance(checksums, list):
+        return None, None
+    published = {c.get('Algorithm', '').upper(): c.get('Value') for c in checksums if c.get('Value')}
+    for algorithm in ('MD5', 'BLAKE3'):
+        if algorithm in published:
+            return algorithm, published[algorithm]
+    return None, None
+
+# Only the attributes used to queue a product, instead of every attribute (footprint, GeoJSON, ...)
+SELECTED_ATTRIBUTES = 'Id,Name,ContentLength,Checksum,ContentDate'
+# Delay before a task that raised is run again, doubled after each failure in a row
+TASK_RETRY_DELAY = 60 # Seconds
+MAX_TASK_RETRY_DELAY = 3600 # Seconds
+
+def queue_products(records, config):
+    '''
+    Add the products of one page of query results that are not already on
+    disk to the download queue.
+
+    Returns the number of products not already on disk and the number added
+    to the queue (products already in the queue are skipped).
+    '''
+    # Remove suffix(es) from filename
+    names = [re.sub(r'(\.\w+){1,2}$', '', record['Name']) for record in records]
+
+    # This needs to only include sensing date(s) not ingestion date since products are updated later and we don't want to redownload.
+    short_names = get_short_names(names)
+
+    if config.get('inventory_db'):
+        # One indexed lookup for the whole page instead of a glob per product
+        stored = get_stored_short_names(config['inventory_db'], short_names)
+        not_on_disk = [short_name not in stored for short_name in short_names]
     else:
-        # Fallback: return full string if mission not recognised
-        return product_name
-
-    return match.group(1) if match else product_name
-
-def query_time_window(url, config, logger):
+        # Full paths without extensions, keep only products where the file does *not* exist
+        base_paths = predict_base_paths(short_names, config['output_dir'], config['product_types_csv'])
+        not_on_disk = [
+            base_path is None or no_matches(os.path.join(base_path, short_name))
+            for base_path, short_name in zip(base_paths, short_names)
+        ]
+
+    products = []
+    for record, name, keep in zip(records, names, not_on_disk):
+        if not keep:
+            continue
+        # Size in bytes, used by the downloader to put products in size lanes
+        size = record.get('ContentLength')
+        size = int(size) if size is not None else None
+        # Published checksum, verified while the product downloads
+        checksum_algorithm, checksum = get_preferred_checksum(record.get('Checksum'))
+        products.append((name, record['Id'], size, checksum_algorithm, checksum))
+
+    added = add_products(config['product_download_queue_db'], products) if products else 0
+    return len(products), added
+
+def query_time_window(url, config, logger, rate_limiter=None):
+    '''
+    Query all pages of a time window, adding the products not already on disk
+    to the download queue as each page arrives, so the downloader can start
+    on them while the next pages are fetched.
+
+    Returns whether every page was fetched and the number of products found.
+    '''
     logger.info(f"Querying: {url}")
-    all_results = []
-
-    response = None
+    found = not_on_disk = added = 0
+    complete = True
 
     while url:
         for attempt in range(1, config['max_query_attempts'] + 1):
+            if rate_limiter is not None:
+                rate_limiter.wait()
             try:
-                r = requests.get(url)
+                r = get_query_session().get(url)
                 if r.ok:
                     response = r.json()
-                    all_results.extend(response.get('value', []))
+                    records = response.get('value', [])
                     url = response.get('@odata.nextLink')
+                    if records:
+                        page_not_on_disk, page_added = queue_products(records, config)
+                        found += len(records)
+                        not_on_disk += page_not_on_disk
+                        added += page_added
                     break
                 else:
                     logger.error(f"Attempt {attempt} failed: HTTP {r.status_code}")
@@ -58,73 +120,44 @@ def query_time_window(url, config, logger):
                 time.sleep(config['wait_time_between_failed_queries'])
             else:
                 logger.error("All attempts failed, moving on to next time window.")
+                url = None
+                complete = False
 
-    if not all_results:
+    if not found:
         logger.info("No products found for the given filters.")
     else:
-        df = pd.DataFrame.from_dict(all_results)
-
-        # Remove suffix(es) from filename
-        df['Product_Name'] = df['Name'].str.replace(r'(\.\w+){1,2}$', '', regex=True)
-
-        # This needs to only include sensing date(s) not ingestion date since products are updated later and we don't want to redownload.
-        df['Short_Name'] = df['Product_Name'].apply(extract_short_name_by_mission)
-
-        # Create a new column with full paths without extensions
-        df['SearchPath'] = df['Short_Name'].apply(lambda name: os.path.join(predict_base_path(name, config['output_dir'], config['product_types_csv']), name))
-
-        # Keep only rows where the file does *not* exist
-        pd.set_option('display.max_colwidth', None)
+        logger.info(f'Number of products found: {found}')
+        logger.info(f'Number of products not already on disk: {not_on_disk}')
+        logger.info(f'Number of products added to the queue: {added}')
 
-        df['matches'] = df['SearchPath'].apply(glob.glob)
+    return complete, found
 
-        logger.info(f'Number of products found: {len(df)}')
-
-        df = df[df['SearchPath'].apply(no_matches)].reset_index(drop=True)
-
-        logger.info(f'Number of products not already on disk: {len(df)}')
-
-        with sqlite3.connect(config['product_download_queue_db']) as conn:
-            cur = conn.cursor()
-
-            # Create table with 'attempts' column if it doesn't exist
-            cur.execute("""
-                CREATE TABLE IF NOT EXISTS products (
-                    name TEXT PRIMARY KEY,
-                    id TEXT,
-                    attempts INTEGER DEFAULT 0
-                )
-            """)
-
-            for _, row in df.iterrows():
-                try:
-                    cur.execute(
-                        "INSERT INTO products (name, id, attempts) VALUES (?, ?, ?)",
-                        (row['Product_Name'], row['Id'], 0)
-                    )
-                except sqlite3.IntegrityError:
-                    # Already exists, skip
-                    pass
-
-        # Deleting df and collecting garbage to avoid memory creep.
-        del df
-        gc.collect()
-
-def create_query_url(config, logger, end_timestamp):
+def create_query_url(config, logger, end_timestamp, start_timestamp=None):
+    start_timestamp = start_timestamp or config['start_timestamp']
     if config['polygon']:
         spatial_filter = f" and OData.CSC.Intersects(area=geography'SRID=4326;{config['polygon']}')"
     else:
         spatial_filter = ''
 
+    # Adaptive windows follow each other without overlap, so they are
+    # half-open, [start, end), on a single instant to cover every product
+    # exactly once. Fixed windows overlap (time_step < time_window) instead.
+    half_open = bool(config.get('target_products_per_query'))
     if config['date_to_filter_by'] == 'ContentDate':
-        temporal_filter = (
-            f"ContentDate/Start gt {config['start_timestamp']} and "
-            f"ContentDate/End lt {end_timestamp} and "
-        )
+        if half_open:
+            temporal_filter = (
+                f"ContentDate/Start ge {start_timestamp} and "
+                f"ContentDate/Start lt {end_timestamp} and "
+            )
+        else:
+            temporal_filter = (
+                f"ContentDate/Start gt {start_timestamp} and "
+                f"ContentDate/End lt {end_timestamp} and "
+            )
 
     elif config['date_to_filter_by'] == 'PublicationDate':
         temporal_filter = (
-            f"PublicationDate gt {config['start_timestamp']} and "
+            f"PublicationDate {'ge' if half_open else 'gt'} {start_timestamp} and "
             f"PublicationDate lt {end_timestamp} and "
         )
     else:
@@ -136,17 +169,146 @@ def create_query_url(config, logger, end_timestamp):
         f"{temporal_filter}"
         f"Collection/Name eq '{config['collection']}'"
         f"{spatial_filter}"
+        f"&$select={SELECTED_ATTRIBUTES}"
         f"&$top={config['products_per_page']}"
     )
 
     return url
 
+def get_sync_state(config):
+    '''
+    Opens the sync state database of the config's collection (see lib/sync_state.py).
+    '''
+    return SyncState(config.get('sync_state_db', f"sync_state_{config['collection']}.db"))
+
+def adapt_time_window(window_minutes, found, config):
+    '''
+    Returns the length in minutes of the next window, scaled from the last
+    one so it would have returned about target_products_per_query products,
+    at most halving or doubling it per window to ride out noisy counts,
+    within min_time_window and max_time_window.
+    '''
+    factor = config['target_products_per_query'] / found if found else 2
+    window_minutes *= min(max(factor, 0.5), 2)
+    window_minutes = min(max(window_minutes, config.get('min_time_window', 1)), config.get('max_time_window', 1440))
+    return max(round(window_minutes), 1)
+
+class CollectionSync:
+    '''
+    The live query loop of one collection, one window at a time.
+
+    query_next_window() queries the next window, if it has passed, and
+    returns when the collection is next due; retry_failed_windows()
+    re-queries the windows that failed. Progress is kept in the sync state
+    database (see lib/sync_state.py).
+    '''
+
+    def __init__(self, config, logger):
+        self.config = config
+        self.logger = logger
+        self.collection = config['collection']
+        self.state = get_sync_state(config)
+        # The config's start_timestamp and time_window only seed the state of a new collection
+        self.start_timestamp = self.state.get_watermark(self.collection, config['start_timestamp'])
+        self.window_minutes = int(config['time_window'])
+        # With target_products_per_query set, windows follow each other without
+        # overlap and their length is adapted to the number of products found
+        self.adaptive = bool(config.get('target_products_per_query'))
+        if self.adaptive:
+            self.window_minutes = self.state.get_window_minutes(self.collection, self.window_minutes)
+
+    def query_next_window(self):
+        '''
+        Query the next window if its end has passed. Returns the time
+        (datetime) the next window is due: now while catching up, or when the
+        end of the next window passes.
+        '''
+        config = self.config
+        now = datetime.now(timezone.utc)
+        start_dt = parse_timestamp(self.start_timestamp)
+        end_dt = start_dt + timedelta(minutes=self.window_minutes)
+        if self.adaptive and end_dt >= now:
+            # Catching up with the present, query up to the last whole minute
+            end_dt = max(now.replace(second=0, microsecond=0), start_dt + timedelta(minutes=config.get('min_time_window', 1)))
+        end_timestamp = format_timestamp(end_dt)
+
+        if end_dt >= now:
+            self.logger.info(f"End time of the next {self.collection} window is in the future, waiting until {end_timestamp}")
+            return end_dt + timedelta(seconds=1)
+
+        url = create_query_url(config, self.logger, end_timestamp, self.start_timestamp)
+
+        complete, found = query_time_window(url, config, self.logger)
+
+        # Record the window, failed ones are retried later, and move on to the next
+        if self.adaptive:
+            next_start_timestamp = end_timestamp
+            if complete:
+                self.window_minutes = adapt_time_window((end_dt - start_dt).total_seconds() / 60, found, config)
+                self.logger.info(f"Next {self.collection} window: {self.window_minutes} minutes")
+        else:
+            next_start_timestamp = format_timestamp(start_dt + timedelta(minutes=int(config['time_step'])))
+        self.state.record_window(
+            self.collection, (self.start_timestamp, end_timestamp), complete, next_start_timestamp,
+            self.window_minutes if self.adaptive else None
+        )
+        self.start_timestamp = next_start_timestamp
+        return datetime.now(timezone.utc)
+
+    def retry_failed_windows(self):
+        '''
+        Re-query the failed windows of the collection, until they succeed or
+        have been tried limit_window_attempts times (no limit if not set).
+        Returns when the next retry pass is due, failed_window_retry_interval
+        seconds from now. Finished windows older than
+        finished_window_retention_days are pruned from the state database.
+        '''
+        for window in self.state.get_windows(self.collection, FAILED, self.config.get('limit_window_attempts')):
+            self.logger.info(f"Retrying failed {self.collection} window {window[0]} - {window[1]}")
+            url = create_query_url(self.config, self.logger, window[1], window[0])
+            complete, _ = query_time_window(url, self.config, self.logger)
+            self.state.record_window(self.collection, window, complete)
+
+        retention = self.config.get('finished_window_retention_days', 30) * 86400
+        pruned = self.state.prune_windows(self.collection, time.time() - retention)
+        if pruned:
+            self.logger.info(f"Pruned {pruned} finished {self.collection} windows from the sync state")
+        return datetime.now(timezone.utc) + timedelta(seconds=self.config.get('failed_window_retry_interval', 3600))
+
 def run_query(
-        mission_config_path
+        mission_config_paths
     ):
-
+    '''
+    Query the collections of one or more mission configs in one process.
+
+    A timer queue holds the next time each collection's next window, and
+    its next retry of failed windows, is due. The process sleeps until the
+    earliest one, so a collection that has caught up is only woken when its
+    next window has passed, while collections catching up take turns. All
+    collections share one pooled HTTP session. A task that raises is
+    logged and run again after a growing delay, so one collection's errors
+    don't stop the others.
+    '''
     logger = init_logging()
 
+    configs = [load_and_combine_configs(path, 'config/config.yaml') for path in mission_config_paths]
+    for inventory_db, output_dir, inventory_workers in {
+        (config['inventory_db'], config['output_dir'], config.get('inventory_workers'))
+        for config in configs if config.get('inventory_db')
+    }:
+        if not inventory_exists(inventory_db):
+            build_inventory(inventory_db, output_dir, inventory_workers)
+
+    # (due time, order of insertion, task) so collections due at the same time take turns
+    order = itertools.count()
+    timers = []
+    failures = {}
+    for config in configs:
+        collection = CollectionSync(config, logger)
+        retry_due = datetime.now(timezone.utc) + timedelta(seconds=config.get('failed_window_retry_interval', 3600))
+        heapq.heappush(timers, (datetime.now(timezone.utc), next(order), collection.query_next_window))
+        heapq.heappush(timers, (retry_due, next(order), collection.retry_failed_windows))
+
     while True:
         # If time after cutoff, terminate the job.
         now = datetime.now(timezone.utc)
@@ -154,30 +316,62 @@ def run_query(
         if now > cutoff:
             sys.exit(f"Current time is after {cutoff.time()}. Terminating before querying starts again in new job.")
 
-        # Load config fresh each time (to pick up updated start_timestamp from mission config)
-        config = load_and_combine_configs(mission_config_path, 'config/config.yaml')
-
-        start_dt = datetime.strptime(config['start_timestamp'], "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc)
-        now = datetime.now(timezone.utc)
-
-        end_dt = start_dt + timedelta(minutes=int(config['time_window']))
-        end_timestamp = end_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
-
-        if end_dt >= now:
-            sleep_time = int(config['time_window']) * 60 / 2
-            logger.info(f"End time is in the future. Sleeping for {sleep_time} seconds...")
+        due, _, task = timers[0]
+        if due > now:
+            sleep_time = (min(due, cutoff) - now).total_seconds() + 1
+            logger.info(f"Nothing due. Sleeping for {sleep_time:.0f} seconds...")
             time.sleep(sleep_time)
             continue
 
-        url = create_query_url(config, logger, end_timestamp)
+        heapq.heappop(timers)
+        try:
+            next_due = task()
+            failures.pop(task, None)
+        except Exception as e:
+            failures[task] = failures.get(task, 0) + 1
+            delay = min(TASK_RETRY_DELAY * 2 ** (failures[task] - 1), MAX_TASK_RETRY_DELAY)
+            logger.error(f"{task.__self__.collection}: {task.__name__} failed ({e}), trying again in {delay} seconds")
+            next_due = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        heapq.heappush(timers, (next_due, next(order), task))
+
+def run_backfill_query(
+        mission_config_path,
+        start_timestamp,
+        end_timestamp,
+        workers=None
+    ):
+    '''
+    Query the windows between start_timestamp and end_timestamp concurrently
+    into the download queue, without moving the live loop's watermark.
+    Windows are recorded in the sync state database, so rerunning the same
+    backfill resumes where it stopped. Returns the windows that failed.
+    '''
+    logger = init_logging()
 
-        query_time_window(url, config, logger)
+    config = load_and_combine_configs(mission_config_path, 'config/config.yaml')
+    if config.get('inventory_db') and not inventory_exists(config['inventory_db']):
+        build_inventory(config['inventory_db'], config['output_dir'], config.get('inventory_workers'))
 
-        # Update config for next iteration
-        next_start_dt = start_dt + timedelta(minutes=int(config['time_step']))
-        start_dt = start_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        next_start_dt = next_start_dt.strftime('%Y-%m-%dT%H:%M:%SZ')
-        update_time_in_config(mission_config_path, start_dt, next_start_dt)
+    windows = split_into_windows(
+        parse_timestamp(start_timestamp), parse_timestamp(end_timestamp),
+        int(config['time_window']), int(config['time_step'])
+    )
+    workers = workers or config.get('backfill_workers', 4)
+    # Shared by all workers, so the backfill stays within the catalogue's request limits
+    rate_limiter = RateLimiter(config.get('backfill_requests_per_second'))
+    # One kept-alive connection per worker
+    get_query_session(workers)
+
+    def query_window(window_start, window_end):
+        url = create_query_url(config, logger, window_end, window_start)
+        complete, _ = query_time_window(url, config, logger, rate_limiter)
+        return complete
+
+    state = get_sync_state(config)
+    try:
+        return run_backfill(config['collection'], windows, query_window, state, workers)
+    finally:
+        state.close()
 
 # Run the loop
 if __name__ == "__main__":
@@ -185,10 +379,25 @@ if __name__ == "__main__":
     # Argument parser setup
     parser = argparse.ArgumentParser(description="Process Sentinel product files.")
 
-    parser.add_argument('--mission_config_path', '-c', default='config/config_production.yaml',
-                        help="Path to the YAML configuration file for that mission")
+    parser.add_argument('--mission_config_path', '-c', nargs='+', default=['config/config_production.yaml'],
+                        help="Path to the YAML configuration file for that mission, several to query them all in one process")
+    parser.add_argument('--backfill', nargs=2, metavar=('START', 'END'), default=None,
+                        help="Query the windows from START to END (e.g. 2024-01-01T00:00:00Z) concurrently instead of running the live loop")
+    parser.add_argument('--workers', '-w', type=int, default=None,
+                        help="Number of windows queried in parallel by --backfill")
     args = parser.parse_args()
 
-    run_query(
-        args.mission_config_path
-    )
\ No newline at end of file
+    if args.backfill:
+        failed = []
+        for mission_config_path in args.mission_config_path:
+            failed += run_backfill_query(
+                mission_config_path,
+                *args.backfill,
+                args.workers
+            )
+        if failed:
+            sys.exit(f"{len(failed)} windows failed, run the backfill again to retry them.")
+    else:
+        run_query(
+            args.mission_config_path
+        )
\ No newline at end of file
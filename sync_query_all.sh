@@ -0,0 +1 @@
+python3 sync_query.py -c ./config/s1_config.yaml ./config/s2_config.yaml ./config/s3_config.yaml ./config/s5_config.yaml ./config/s6_config.yaml
\ No newline at end of file